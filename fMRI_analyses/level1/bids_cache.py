@@ -0,0 +1,64 @@
+"""
+On-disk cache of the BIDSLayout index, and memoized metadata lookups.
+
+The pickled layout is reused as long as the raw BIDS inputs are unchanged: the top-level
+files (dataset description and inherited sidecars such as task-*_bold.json) and every
+directory of the sub-* trees (a file added, removed or renamed changes its directory's mtime).
+derivatives/, fmriprep/ and the other top-level directories are not part of the signature,
+so pipeline outputs (including the cache file itself) do not invalidate it, and they are
+never walked.
+"""
+
+import os
+import pickle as pkl
+from bids.grabbids import BIDSLayout
+from units import make_dir
+
+_metadata = {}
+
+
+def tree_signature(root, cache_file=None):
+    # modification times of the top-level files and of every directory under the sub-* directories,
+    # leaving out the cache file (and its temporary copies) and its directory
+    cache_file = os.path.abspath(cache_file) if cache_file else None
+    cache_dir = os.path.dirname(cache_file) if cache_file else None
+    signature = {}
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if name.startswith('sub-') and os.path.isdir(path):
+            for dirpath, _, _ in os.walk(path):
+                if os.path.abspath(dirpath) != cache_dir:
+                    signature[dirpath] = os.stat(dirpath).st_mtime
+        elif os.path.isfile(path) and not (cache_file and os.path.abspath(path).startswith(cache_file)):
+            signature[path] = os.stat(path).st_mtime
+    return signature
+
+
+def get_layout(bids_dir, cache_file):
+    """
+    Load the BIDSLayout of bids_dir from cache_file, or index it again if the tree changed.
+    :param bids_dir: BIDS root directory
+    :param cache_file: pickle file holding the layout and the directory mtimes it was built from
+    :return: a BIDSLayout
+    """
+    signature = tree_signature(bids_dir, cache_file)
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as infile:
+            cached = pkl.load(infile)
+        if cached['signature'] == signature:
+            return cached['layout']
+    print('Indexing ' + bids_dir)
+    layout = BIDSLayout(bids_dir)
+    make_dir(os.path.dirname(os.path.abspath(cache_file)))
+    tmp_file = cache_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'wb') as outfile:
+        pkl.dump({'signature': signature, 'layout': layout}, outfile, protocol=pkl.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, cache_file)  # atomic, so concurrent invocations never read a partial cache
+    return layout
+
+
+def get_metadata(layout, filename):
+    # layout.get_metadata, looked up once per file
+    if filename not in _metadata:
+        _metadata[filename] = layout.get_metadata(filename)
+    return _metadata[filename]
@@ -0,0 +1,92 @@
+"""
+Design matrices built in Python (double-gamma HRF with temporal derivative, drift basis),
+for the NumPy GLM and for design-efficiency checks.
+
+All conditions are convolved together in one FFT on a grid of MICROTIME bins per TR and then
+sampled at every TR.  Designs and drift bases are memoized on their timing, so runs with
+identical timing (and repeated models on the same run) reuse the same matrices.
+"""
+
+import numpy as np
+from scipy.stats import gamma
+
+MICROTIME = 16  # time bins per TR for the convolution
+_designs = {}
+_dct = {}
+
+
+def double_gamma(dt, length=32.):
+    # canonical double-gamma HRF (peak at 6s, undershoot at 16s), sampled every dt seconds
+    t = np.arange(0, length, dt)
+    hrf = gamma.pdf(t, 6) - gamma.pdf(t, 16) / 6.
+    return hrf / hrf.sum()
+
+
+def boxcars(onsets, durations, tr, n_vols):
+    # condition x time bin array of 0/1 event indicators on the high resolution grid
+    dt = float(tr) / MICROTIME
+    n_bins = n_vols * MICROTIME
+    counts = [len(o) for o in onsets]
+    cond = np.repeat(np.arange(len(onsets)), counts)
+    start = np.round(np.concatenate([np.asarray(o, dtype=float) for o in onsets] + [[]]) / dt).astype(int)
+    length = np.round(np.concatenate([np.asarray(d, dtype=float) for d in durations] + [[]]) / dt).astype(int)
+    stop = np.clip(start + np.maximum(length, 1), 0, n_bins)
+    start = np.clip(start, 0, n_bins)
+    edges = np.zeros((len(onsets), n_bins + 1))
+    np.add.at(edges, (cond, start), 1)
+    np.add.at(edges, (cond, stop), -1)
+    return np.minimum(np.cumsum(edges, axis=1)[:, :n_bins], 1)
+
+
+def design_matrix(onsets, durations, tr, n_vols, derivs=True):
+    """
+    HRF-convolved regressors of all conditions.
+    :param onsets: a list of onset lists (seconds), one per condition
+    :param durations: a list of duration lists (seconds), one per condition
+    :param tr: repetition time in seconds
+    :param n_vols: number of volumes
+    :param derivs: add each condition's temporal derivative (orthogonalized) right after it, as FEAT does
+    :return: n_vols x (conditions, or 2 * conditions) array
+    """
+    key = (float(tr), n_vols, derivs,
+           tuple(tuple(float(v) for v in o) for o in onsets), tuple(tuple(float(v) for v in d) for d in durations))
+    if key not in _designs:
+        dt = float(tr) / MICROTIME
+        hrf = double_gamma(dt)
+        kernels = np.array([hrf, np.gradient(hrf, dt)]) if derivs else hrf[None, :]
+        box = boxcars(onsets, durations, tr, n_vols)
+        n_fft = 1 << int(np.ceil(np.log2(box.shape[1] + len(hrf) - 1)))
+        conv = np.fft.irfft(np.fft.rfft(box, n_fft)[:, None, :] * np.fft.rfft(kernels, n_fft)[None, :, :], n_fft)
+        conv = conv[:, :, :box.shape[1]:MICROTIME]  # condition x kernel x volume
+        if derivs:
+            main, deriv = conv[:, 0], conv[:, 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                proj = np.nan_to_num(np.einsum('cv,cv->c', deriv, main) / np.einsum('cv,cv->c', main, main))
+            conv[:, 1] = deriv - proj[:, None] * main
+        _designs[key] = conv.reshape(-1, n_vols).T
+    return _designs[key].copy()
+
+
+def dct_basis(tr, n_vols, cutoff=128.):
+    """
+    Orthonormal discrete cosine drift regressors below 1/cutoff Hz (the high-pass filter as a regression basis),
+    the first column being the constant (mean) term.
+    Built once per (TR, n_vols, cutoff) and shared, read-only, by every run and model with that timing.
+    :return: n_vols x (1 + n_basis) array
+    """
+    key = (float(tr), n_vols, float(cutoff))
+    if key not in _dct:
+        n_basis = int(np.floor(2. * n_vols * tr / cutoff))
+        t = np.arange(n_vols)
+        basis = np.sqrt(2. / n_vols) * np.cos(np.pi * np.outer(2 * t + 1, np.arange(n_basis + 1)) / (2. * n_vols))
+        basis[:, 0] = 1. / np.sqrt(n_vols)
+        basis.flags.writeable = False
+        _dct[key] = basis
+    return _dct[key]
+
+
+def efficiency(design, con_matrix):
+    # design efficiency of each contrast row, 1 / (c (X'X)^-1 c')
+    design = design - design.mean(axis=0)
+    xtx_inv = np.linalg.pinv(design.T.dot(design))
+    return 1. / np.einsum('ij,jk,ik->i', con_matrix, xtx_inv, con_matrix)
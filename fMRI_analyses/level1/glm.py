@@ -0,0 +1,262 @@
+"""
+Voxelwise GLM in NumPy, an in-process alternative to fsl.FILMGLS.
+
+The design from FEATModel (design.mat) is fitted to all in-mask voxels at once
+by least squares, and the T and F contrasts are computed from the same
+`contrasts` lists given to Level1Design.  Optionally the fit is prewhitened with a
+voxelwise AR(1) model whose coefficients are spatially smoothed, in the spirit of
+FILM's autocorrelation estimate but with vectorized array operations.  Output maps are named like the
+FILMGLS results (pe1, cope1, varcope1, tstat1, fstat1, sigmasquareds).
+
+To compare with FILMGLS outputs of the same run:
+    python glm.py <filmgls results dir> <numpy glm results dir>
+"""
+
+import os
+import sys
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter
+from design import dct_basis
+from units import make_dir
+
+VOXEL_CHUNK = 20000  # number of voxels fitted together
+VOLUME_BLOCK = 50  # number of volumes read at a time when masking
+AR_SMOOTH_FWHM = 5.  # spatial smoothing of the AR(1) coefficients (mm)
+AR_PRECISION = 0.01  # voxels whose smoothed AR(1) coefficients round to the same value share a whitened fit
+
+
+def read_vest(filename):
+    """
+    Read an FSL VEST text file (design.mat, design.con, design.fts).
+    :return: a dictionary of the /Header values, and the matrix as a 2D array
+    """
+    header = {}
+    rows = []
+    in_matrix = False
+    with open(filename) as infile:
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            if in_matrix:
+                rows.append([float(v) for v in line.split()])
+            elif line.startswith('/Matrix'):
+                in_matrix = True
+            elif line.startswith('/'):
+                key, _, value = line[1:].partition('\t' if '\t' in line else ' ')
+                header[key] = value.strip()
+    return header, np.array(rows, ndmin=2)
+
+
+def contrast_matrices(contrasts, conditions, n_columns, derivs=True):
+    """
+    Turn the Level1Design contrast lists into contrast weights over the design columns.
+    :param contrasts: list of ['name', 'T', [conditions], [weights]] and ['name', 'F', [T contrasts]]
+    :param conditions: condition names in the order they enter the design
+    :param n_columns: number of columns in the design matrix
+    :param derivs: whether every condition is followed by its temporal derivative column
+    :return: T contrast names, T contrast matrix (n_tcons x n_columns),
+             F contrast names, and for each F contrast the indices of its T contrasts
+    """
+    step = 2 if derivs else 1
+    t_names, t_rows, f_names, f_rows = [], [], [], []
+    for con in contrasts:
+        if con[1] == 'T':
+            row = np.zeros(n_columns)
+            for cond, weight in zip(con[2], con[3]):
+                row[conditions.index(cond) * step] = weight
+            t_names.append(con[0])
+            t_rows.append(row)
+    for con in contrasts:
+        if con[1] == 'F':
+            f_names.append(con[0])
+            f_rows.append([t_names.index(t_con[0]) for t_con in con[2]])
+    return t_names, np.array(t_rows, ndmin=2), f_names, f_rows
+
+
+def fit(data, design):
+    """
+    Ordinary least squares for many voxels at once.
+    :param data: time x voxel array
+    :param design: time x regressor design matrix
+    :return: betas (regressor x voxel), residual variance per voxel, (X'X)^-1, degrees of freedom
+    """
+    design = design - design.mean(axis=0)
+    pinv = np.linalg.pinv(design)
+    dof = design.shape[0] - np.linalg.matrix_rank(design)
+    betas = np.empty((design.shape[1], data.shape[1]))
+    sigma2 = np.empty(data.shape[1])
+    for start in range(0, data.shape[1], VOXEL_CHUNK):
+        chunk = np.asarray(data[:, start:start + VOXEL_CHUNK], dtype=np.float64)
+        chunk = chunk - chunk.mean(axis=0)
+        betas[:, start:start + VOXEL_CHUNK] = pinv.dot(chunk)
+        resid = chunk - design.dot(betas[:, start:start + VOXEL_CHUNK])
+        sigma2[start:start + VOXEL_CHUNK] = np.einsum('tv,tv->v', resid, resid) / dof
+    return betas, sigma2, pinv.dot(pinv.T), dof
+
+
+def highpass(data, tr, cutoff=128.):
+    """
+    Remove the mean and the cosine drift below 1/cutoff Hz from every column, in place.
+    The mean and drift basis comes from design.dct_basis, so it is computed once per (TR, n_vols) and shared.
+    :param data: time x column float array (bold data or design matrix)
+    :return: data
+    """
+    basis = dct_basis(tr, len(data), cutoff)
+    for start in range(0, data.shape[1], VOXEL_CHUNK):
+        chunk = data[:, start:start + VOXEL_CHUNK]
+        chunk -= basis.dot(basis.T.dot(chunk)).astype(data.dtype)
+    return data
+
+
+def ar1_coefficients(data, design):
+    # lag-1 autocorrelation of the OLS residuals of every voxel
+    pinv = np.linalg.pinv(design)
+    rho = np.empty(data.shape[1])
+    for start in range(0, data.shape[1], VOXEL_CHUNK):
+        chunk = np.asarray(data[:, start:start + VOXEL_CHUNK], dtype=np.float64)
+        resid = chunk - design.dot(pinv.dot(chunk))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho[start:start + VOXEL_CHUNK] = np.einsum('tv,tv->v', resid[1:], resid[:-1]) / \
+                                              np.einsum('tv,tv->v', resid, resid)
+    return np.nan_to_num(rho)
+
+
+def smooth_in_mask(values, mask, affine, fwhm):
+    # gaussian smoothing of in-mask voxel values, normalized so voxels near the mask edge are not pulled to 0
+    sigma = fwhm / 2.3548 / np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    vol = np.zeros(mask.shape)
+    vol[mask] = values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (gaussian_filter(vol, sigma) / gaussian_filter(mask.astype(float), sigma))[mask]
+
+
+def ar1_groups(data, design, mask, affine):
+    """
+    Smoothed voxelwise AR(1) coefficients, rounded to AR_PRECISION.
+    :return: a list of (AR(1) coefficient, indices of the voxels with that coefficient)
+    """
+    rho = smooth_in_mask(ar1_coefficients(data, design), mask, affine, AR_SMOOTH_FWHM)
+    rho = np.round(np.clip(rho, -0.99, 0.99) / AR_PRECISION) * AR_PRECISION
+    values, inverse = np.unique(rho, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(values)))[:-1]
+    return list(zip(values, np.split(order, bounds)))
+
+
+def whiten(x, rho):
+    # AR(1) prewhitening along the time axis
+    if rho == 0:
+        return x
+    x = np.asarray(x, dtype=np.float64)
+    white = np.empty_like(x)
+    white[0] = np.sqrt(1 - rho ** 2) * x[0]
+    white[1:] = x[1:] - rho * x[:-1]
+    return white
+
+
+def t_contrasts(betas, sigma2, xtx_inv, t_matrix):
+    # cope, varcope and t statistics, one row per contrast
+    cope = t_matrix.dot(betas)
+    varcope = np.einsum('ij,jk,ik->i', t_matrix, xtx_inv, t_matrix)[:, None] * sigma2[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstat = np.where(varcope > 0, cope / np.sqrt(varcope), 0)
+    return cope, varcope, tstat
+
+
+def f_contrast(betas, sigma2, xtx_inv, con_matrix):
+    # F statistic of a set of contrasts
+    cb = con_matrix.dot(betas)
+    inner = np.linalg.pinv(con_matrix.dot(xtx_inv).dot(con_matrix.T))
+    rank = np.linalg.matrix_rank(con_matrix)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fstat = np.einsum('iv,ij,jv->v', cb, inner, cb) / (rank * sigma2)
+    return np.where(sigma2 > 0, fstat, 0)
+
+
+def load_masked(in_file, mask_file, first_volume=0):
+    """
+    Brain-masked time series of a run, without writing a masked copy of the image.
+    The image is read VOLUME_BLOCK volumes at a time: uncompressed images are memory-mapped, and
+    compressed ones are read as one gzip stream kept open across the blocks.
+    :param in_file: preprocessed 4D bold image
+    :param mask_file: brain mask of the run
+    :param first_volume: leading volumes to skip (virtually trimmed non-steady volumes)
+    :return: time x in-mask voxel float32 array, the boolean mask, and the image affine
+    """
+    img = nib.load(in_file, mmap=True, keep_file_open=True)
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    data = np.empty((img.shape[3] - first_volume, np.count_nonzero(mask)), dtype=np.float32)
+    for start in range(0, len(data), VOLUME_BLOCK):
+        block = img.dataobj[..., first_volume + start:first_volume + start + VOLUME_BLOCK]
+        data[start:start + VOLUME_BLOCK] = block[mask].T
+    return data, mask, img.affine
+
+
+def save_map(values, mask, affine, filename):
+    # write in-mask voxel values as a 3D image
+    vol = np.zeros(mask.shape, dtype=np.float32)
+    vol[mask] = values
+    nib.Nifti1Image(vol, affine).to_filename(filename)
+
+
+def fit_contrasts(data, design, t_matrix, f_rows):
+    # every output map of one fit, as {name: (n_maps x voxel) array}
+    betas, sigma2, xtx_inv, dof = fit(data, design)
+    cope, varcope, tstat = t_contrasts(betas, sigma2, xtx_inv, t_matrix)
+    maps = {'pe': betas, 'cope': cope, 'varcope': varcope, 'tstat': tstat, 'sigmasquareds': sigma2[None, :]}
+    if f_rows:
+        maps['fstat'] = np.array([f_contrast(betas, sigma2, xtx_inv, t_matrix[rows]) for rows in f_rows])
+    return maps, dof
+
+
+def run_glm(data, mask, affine, design, contrasts, conditions, out_dir, ar1=False):
+    """
+    Fit the design of one run to every voxel in the brain mask and write the contrast maps.
+    :param data: time x in-mask voxel array (from load_masked)
+    :param mask: boolean brain mask the voxels were taken from
+    :param affine: affine of the output maps
+    :param design: time x regressor design matrix (read_vest of FEATModel's design.mat, or design.py)
+    :param contrasts: Level1Design contrast lists
+    :param conditions: condition names in design order
+    :param out_dir: output directory, created if needed
+    :param ar1: prewhiten with the smoothed voxelwise AR(1) coefficients
+    :return: out_dir
+    """
+    make_dir(out_dir)
+    _, t_matrix, _, f_rows = contrast_matrices(contrasts, conditions, design.shape[1])
+    groups = ar1_groups(data, design, mask, affine) if ar1 else [(0, slice(None))]
+    maps = {}
+    for rho, voxels in groups:
+        group_maps, dof = fit_contrasts(whiten(data[:, voxels], rho), whiten(design, rho), t_matrix, f_rows)
+        for name, values in group_maps.items():
+            if name not in maps:
+                maps[name] = np.zeros((len(values), data.shape[1]))
+            maps[name][:, voxels] = values
+    for name, values in maps.items():
+        if name == 'sigmasquareds':
+            save_map(values[0], mask, affine, os.path.join(out_dir, 'sigmasquareds.nii.gz'))
+            continue
+        for i, vals in enumerate(values):
+            save_map(vals, mask, affine, os.path.join(out_dir, '%s%d.nii.gz' % (name, i + 1)))
+    with open(os.path.join(out_dir, 'dof'), 'w') as outfile:
+        outfile.write('%d\n' % dof)
+    return out_dir
+
+
+def compare(film_dir, numpy_dir):
+    # print how closely the numpy stat maps follow the FILMGLS ones
+    for fname in sorted(os.listdir(numpy_dir)):
+        if not (fname.startswith('tstat') or fname.startswith('fstat')) \
+                or not os.path.exists(os.path.join(film_dir, fname)):
+            continue
+        film = np.asanyarray(nib.load(os.path.join(film_dir, fname)).dataobj)
+        ours = np.asanyarray(nib.load(os.path.join(numpy_dir, fname)).dataobj)
+        inside = (film != 0) | (ours != 0)
+        r = np.corrcoef(film[inside], ours[inside])[0, 1]
+        print('%s\tr=%.6f\tmax abs diff=%.6f' % (fname, r, np.abs(film[inside] - ours[inside]).max()))
+
+
+if __name__ == '__main__':
+    compare(sys.argv[1], sys.argv[2])
@@ -0,0 +1,60 @@
+# Subjects modeled at level 1 (and stacked at level 2)
+SUBJECTS = ['132', '133', '134', '136', '137', '138', '139', '142', '143', '144', '145', '146', '148']
+
+# Level 1 models (python post_fmriprep_lv1.py <model name>[,<model name>...] [n processes])
+#   task:             BIDS task name
+#   num_runs:         number of runs per subject
+#   excluding:        {subject index in SUBJECTS: run index} of runs left out of the model
+#   group_by:         event columns whose values define the conditions
+#   conditions:       condition name -> values of the group_by columns, in design order
+#   onset_offset:     added to the event onsets (seconds)
+#   duration_offset:  added to the event durations (seconds)
+#   t_contrasts:      one T contrast per listed condition, in this order (tstat1, tstat2, ...)
+#   f_contrast:       name of the F contrast over all T contrasts
+MODELS = {
+    'nav-bin': {
+        'task': 'face',
+        'num_runs': 6,
+        'excluding': {},
+        'group_by': ['direction'],
+        'conditions': [('u', ('u',)), ('d', ('d',))],
+        'onset_offset': 0,
+        'duration_offset': -2,
+        't_contrasts': ['u', 'd'],
+        'f_contrast': 'all nav',
+    },
+    'nav-multi': {
+        'task': 'face',
+        'num_runs': 6,
+        'excluding': {4: 5},  # excluding the 6th run from the 5th subject in SUBJECTS (sub-137, run-06)
+        'group_by': ['direction', 'steps'],
+        'conditions': [('u2', ('u', 2)), ('u3', ('u', 3)), ('u4', ('u', 4)),
+                       ('d2', ('d', 2)), ('d3', ('d', 3)), ('d4', ('d', 4))],
+        'onset_offset': 0,
+        'duration_offset': -2,
+        't_contrasts': ['u2', 'd2', 'u3', 'd3', 'u4', 'd4'],
+        'f_contrast': 'all nav',
+    },
+    'face': {
+        'task': 'face',
+        'num_runs': 6,
+        'excluding': {4: 5},  # excluding the 6th run from the 5th subject in SUBJECTS (sub-137, run-06)
+        'group_by': ['anchor'],
+        'conditions': [('no2', (2,)), ('no3', (3,)), ('no4', (4,)), ('no5', (5,)), ('no6', (6,))],
+        'onset_offset': -2,
+        'duration_offset': -5,
+        't_contrasts': ['no2', 'no3', 'no4', 'no5', 'no6'],
+        'f_contrast': 'all face',
+    },
+    'sac': {
+        'task': 'sacc',
+        'num_runs': 2,
+        'excluding': {},
+        'group_by': ['direction'],
+        'conditions': [('up', ('up',)), ('down', ('down',)), ('left', ('left',)), ('right', ('right',))],
+        'onset_offset': 0,
+        'duration_offset': 0,
+        't_contrasts': ['up', 'down', 'left', 'right'],
+        'f_contrast': 'all sacc',
+    },
+}
@@ -0,0 +1,47 @@
+"""
+Per-(subject, run, model) manifest of what went into each level 1 result.
+
+Every unit gets a hash of its inputs: the size and mtime of its image files, and the
+content of its model (onsets and durations from the events, confound regressors,
+conditions, contrasts and settings).  A rerun only needs to compute the units whose
+hash differs from the one recorded with their output, or whose output is missing.
+"""
+
+import hashlib
+import json
+import os
+
+
+def unit_hash(files, *values):
+    """
+    :param files: image files of the unit (hashed by path, size and mtime, since they are several GB each)
+    :param values: anything else the result depends on, hashed by content (must be JSON serializable)
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    for filename in files:
+        stat = os.stat(filename)
+        sha.update(('%s %d %d\n' % (filename, stat.st_size, stat.st_mtime)).encode())
+    sha.update(json.dumps(values, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def load_manifest(filename):
+    # {unit name: {'hash': ..., 'output': ...}}
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as infile:
+        return json.load(infile)
+
+
+def save_manifest(filename, manifest):
+    tmp_file = filename + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'w') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.rename(tmp_file, filename)
+
+
+def is_current(manifest, name, digest):
+    # whether the unit's recorded output was made from the same inputs and still exists
+    entry = manifest.get(name)
+    return entry is not None and entry['hash'] == digest and os.path.exists(entry['output'])
@@ -0,0 +1,91 @@
+"""
+Motion and non-steady-state QC of every fMRIPrep run, in one table (QC_FILE).
+
+The confounds of all runs are loaded through the columnar store (only the motion and
+NonSteadyStateOutlier columns are parsed) by a pool of threads, and each run is summarized
+with array operations:
+    n_volumes, max_translation, max_rotation (radians), max_X/Y/Z (largest signed position),
+    big_moves (X/Y/Z positions over XYZ_MOVEMENT_CRITERION), fd_mean, fd_max,
+    fd_over (volumes with FramewiseDisplacement over FD_THRESHOLD),
+    nonsteady (number of NonSteadyStateOutlier volumes), leading_nonsteady (how many of them
+    are the first volumes of the run), nonsteady_rows.
+
+Usage: python motion_qc.py [n threads]
+"""
+
+import os
+import re
+import sys
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+from tsv_store import load_confounds, confound_columns
+
+PATH = '../fmriprep/'
+QC_FILE = 'motion_qc.csv'
+XYZ_MOVEMENT_CRITERION = 2.5  # mm
+FD_THRESHOLD = 0.5  # mm
+N_THREADS = 8  # confounds files loaded at a time
+
+
+def confound_files(path):
+    # (subject, confounds.tsv path) of every run of the subjects with an fMRIPrep report
+    subjects = sorted(f[:7] for f in os.listdir(path) if f.endswith('.html') and f.startswith('sub'))
+    files = []
+    for subj in subjects:
+        filepath = path + subj + '/func/'
+        files += [(subj, filepath + f) for f in sorted(os.listdir(filepath))
+                  if f.startswith('sub') and f.endswith('confounds.tsv')]
+    return files
+
+
+def scan_run(job):
+    subj, tsv_file = job
+    fname = os.path.basename(tsv_file)
+    confounds = load_confounds(tsv_file)
+    xyz = np.column_stack([confounds[axis] for axis in ('X', 'Y', 'Z')])
+    rot = np.column_stack([confounds[axis] for axis in ('RotX', 'RotY', 'RotZ')])
+    fd = confounds['FramewiseDisplacement']  # n/a for the first volume
+    cols = confound_columns(confounds, 'NonSteadyStateOutlier')
+    unsteady = np.sum([confounds[c] for c in cols], axis=0) if cols else np.zeros(len(xyz))
+    unsteady_rows = np.flatnonzero(unsteady == 1)
+    task = re.findall(r'_task-[^_]+_', fname)[0][6:-1]
+    run = re.findall(r'_run-\d+_', fname)
+    return {'subject': subj, 'task': task, 'run': int(run[0][5:-1]) if run else 0, 'file': fname,
+            'n_volumes': len(xyz),
+            'max_translation': np.abs(xyz).max(), 'max_rotation': np.abs(rot).max(),
+            'max_X': xyz[:, 0].max(), 'max_Y': xyz[:, 1].max(), 'max_Z': xyz[:, 2].max(),
+            'big_moves': np.count_nonzero(xyz > XYZ_MOVEMENT_CRITERION),
+            'fd_mean': np.nanmean(fd), 'fd_max': np.nanmax(fd), 'fd_over': np.count_nonzero(fd > FD_THRESHOLD),
+            'nonsteady': len(unsteady_rows),
+            'leading_nonsteady': np.count_nonzero(unsteady_rows == np.arange(len(unsteady_rows))),
+            'nonsteady_rows': str(unsteady_rows.tolist())}
+
+
+def scan(path, n_threads=N_THREADS):
+    """
+    :param path: fMRIPrep output directory
+    :param n_threads: number of confounds files loaded at a time
+    :return: QC DataFrame, one row per run, ordered by file
+    """
+    pool = ThreadPool(n_threads)
+    rows = pool.map(scan_run, confound_files(path))
+    pool.close()
+    pool.join()
+    return pd.DataFrame(rows, columns=list(rows[0]) if rows else None)
+
+
+def main():
+    qc = scan(PATH, int(sys.argv[1]) if len(sys.argv) > 1 else N_THREADS)
+    qc.to_csv(QC_FILE, index=False)
+    big = qc[qc.big_moves > 0]
+    print('%d runs of %d subjects: %d with big movements, %d with non-steady volumes, %d with FD > %.1f'
+          % (len(qc), qc.subject.nunique(), len(big), np.count_nonzero(qc.nonsteady),
+             np.count_nonzero(qc.fd_over), FD_THRESHOLD))
+    for _, row in big.iterrows():
+        print('Big movements in %s: %d volumes, max X/Y/Z %.2f %.2f %.2f'
+              % (row.file, row.big_moves, row.max_X, row.max_Y, row.max_Z))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Streaming .nii.gz writing, one volume at a time.
+
+NIfTI-1 stores a 4D image as its header followed by consecutive Fortran-ordered volumes, so
+a 4D file can be written (or trimmed) volume by volume without holding the whole image.
+Volumes are compressed as separate gzip members by a pool of threads (zlib releases the GIL),
+and the members are concatenated in order, which is still a valid gzip file.
+
+Leading non-steady volumes can also be dropped virtually: the number of volumes to skip is
+recorded in a sidecar next to the preproc file (<preproc name>_trim.json), and the readers
+start at that volume instead of the file being rewritten.
+"""
+
+import gzip
+import json
+import os
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from nibabel.openers import ImageOpener
+
+COMPRESS_THREADS = 4  # threads compressing volumes in parallel
+COMPRESS_LEVEL = 1  # nibabel's default gzip level
+NIFTI_HEADER_SIZE = 348
+TRIM_SIDECAR = '_trim.json'  # replaces .nii.gz / .nii of the preproc file
+
+
+def write_gzip(blocks, out_file, n_threads=COMPRESS_THREADS):
+    """
+    Compress byte blocks into a gzip file, in parallel but in order, with at most 2 blocks per thread in memory.
+    The file is written to a temporary name first and renamed when complete.
+    :param blocks: iterable of bytes (e.g. the header, then each volume)
+    :param out_file: output .gz file
+    :return: out_file
+    """
+    tmp_file = out_file + '.%d.tmp' % os.getpid()
+    pool = ThreadPool(n_threads)
+    pending = deque()
+    try:
+        with open(tmp_file, 'wb') as outfile:
+            for block in blocks:
+                pending.append(pool.apply_async(gzip.compress, (block, COMPRESS_LEVEL)))
+                if len(pending) >= 2 * n_threads:
+                    outfile.write(pending.popleft().get())
+            while pending:
+                outfile.write(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    os.rename(tmp_file, out_file)
+    return out_file
+
+
+def header_block(header):
+    # header bytes and the empty extension flag, up to the data offset
+    header['vox_offset'] = NIFTI_HEADER_SIZE + 4
+    return header.binaryblock + b'\0' * 4
+
+
+def volume_block(values, dtype):
+    return np.asarray(values).astype(dtype).tobytes(order='F')
+
+
+def trim_volumes(img, out_file, n_drop, n_threads=COMPRESS_THREADS):
+    """
+    Copy a 4D image without its first n_drop volumes.
+    The stored bytes are copied as they are (same data type, scaling and extensions), reading the
+    input sequentially through nibabel's opener, so the data is never decoded or held as a whole.
+    :param img: nibabel image of the input file
+    :param out_file: output .nii.gz file
+    :param n_drop: number of leading volumes to remove
+    :return: out_file
+    """
+    # nibabel moves the scaling and the data offset from a loaded header to its array proxy
+    vox_offset = img.dataobj.offset
+    header = img.header.copy()
+    header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    header['vox_offset'] = vox_offset
+    n_vols = img.shape[3]
+    header.set_data_shape(img.shape[:3] + (n_vols - n_drop,))
+    vol_bytes = int(np.prod(img.shape[:3])) * img.get_data_dtype().itemsize
+
+    def blocks(infile):
+        # header with the new shape, the original extensions, then the kept volumes
+        yield header.binaryblock + infile.read(vox_offset)[NIFTI_HEADER_SIZE:]
+        infile.seek(vox_offset + n_drop * vol_bytes)
+        for _ in range(n_vols - n_drop):
+            yield infile.read(vol_bytes)
+
+    with ImageOpener(img.get_filename(), 'rb') as infile:
+        return write_gzip(blocks(infile), out_file, n_threads)
+
+
+def read_volumes(img, first_volume=0):
+    # scaled volumes of a 4D image from first_volume on, read sequentially through nibabel's opener
+    shape = img.shape[:3]
+    dtype = img.get_data_dtype()
+    vol_bytes = int(np.prod(shape)) * dtype.itemsize
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    with ImageOpener(img.get_filename(), 'rb') as infile:
+        infile.seek(img.dataobj.offset + first_volume * vol_bytes)
+        for _ in range(first_volume, img.shape[3]):
+            yield np.frombuffer(infile.read(vol_bytes), dtype).reshape(shape, order='F') * slope + inter
+
+
+def trim_sidecar(preproc_file):
+    return preproc_file[:preproc_file.index('.nii')] + TRIM_SIDECAR
+
+
+def write_virtual_trim(preproc_file, n_drop):
+    with open(trim_sidecar(preproc_file), 'w') as outfile:
+        json.dump({'NonSteadyVolumes': n_drop}, outfile)
+
+
+def virtual_trim(preproc_file):
+    # number of leading volumes of the preproc file to skip on read (0 without a sidecar)
+    if not os.path.exists(trim_sidecar(preproc_file)):
+        return 0
+    with open(trim_sidecar(preproc_file)) as infile:
+        return json.load(infile)['NonSteadyVolumes']
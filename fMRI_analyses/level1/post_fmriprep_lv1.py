@@ -10,100 +10,72 @@ import nipype.algorithms.modelgen as model   # model generation
 from nipype.interfaces import fsl
 from nipype.interfaces.base import Bunch
 from nipype.caching import Memory
-from bids.grabbids import BIDSLayout
-import pandas as pd
+import numpy as np
+import nibabel as nib
 import os
 import sys
+import glm
+import design
+from bids_cache import get_layout, get_metadata
+from tsv_store import CONFOUNDS, load_confounds, load_events
+from nifti_stream import virtual_trim, read_volumes, write_gzip, header_block, volume_block
+from manifest import unit_hash, load_manifest, save_manifest, is_current
+from lv1_config import MODELS, SUBJECTS
+from units import make_dir, run_units
 
+ARGV = [arg for arg in sys.argv if not arg.startswith('--')]
+MODEL_NAMES = ARGV[1].split(',')  # models of the same task can be fitted together, e.g. nav-bin,nav-multi,face
 
 # Path
 BIDS_DIR = '/u/project/cparkins/data/hierarchy/'
 PREPROC_DIR = '/u/project/cparkins/data/hierarchy/fmriprep/output/fmriprep/'
-MEM_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/work/%s/' % sys.argv[1]
-# Subjects & runs
-SUBJECTS = ['132', '133', '134', '136', '137', '138', '139', '142', '143', '144', '145', '146', '148']
-EXCLUDING = {}  # excluding the 6th run from the 5th subject in the above list (sub-137, run-06) only for nav-multi
+MEM_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/work/%s/'  # per model
+SHARED_MEM_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/work/shared/'  # steps shared by all models
+MANIFEST = MEM_DIR + 'manifest.json'
+LAYOUT_CACHE = '/u/project/cparkins/data/hierarchy/derivatives/lv1/work/bids_layout.pkl'  # shared by all models
+# Execution
+N_PROC = int(ARGV[2]) if len(ARGV) > 2 else 1  # number of subject/run units processed in parallel
+DRY_RUN = '--dry-run' in sys.argv  # only list the units that would be recomputed
+GLM_BACKEND = 'fsl'  # 'numpy': fit the FEATModel design in-process (glm.py) instead of FILMGLS
+DESIGN_BUILDER = 'fsl'  # 'python': numpy GLM designs from design.py instead of SpecifyModel/Level1Design/FEATModel
+PREWHITEN = True  # numpy GLM: voxelwise AR(1) prewhitening with spatially smoothed coefficients
+HIGH_PASS_CUTOFF = 128.
 # Experiment info
-if sys.argv[1] == 'nav-bin':
-    task = 'face'
-    num_runs = 6
-    conditions = ['u', 'd']
-    onsets = lambda event: [list(event[event.direction == 'u'].onset),
-                            list(event[event.direction == 'd'].onset)]
-    durations = lambda event: [list(event[event.direction == 'u'].duration - 2),
-                               list(event[event.direction == 'd'].duration - 2)]
-    up_cond = ['u', 'T', ['u'], [1]]
-    down_cond = ['d', 'T', ['d'], [1]]
-    all_nav = ['all nav', 'F', [up_cond, down_cond]]
-    contrasts = [up_cond, down_cond, all_nav]
-
-elif sys.argv[1] == 'nav-multi':
-    EXCLUDING = {4: 5}  # excluding the 6th run from the 5th subject in the above list (sub-137, run-06)
-    task = 'face'
-    num_runs = 6
-    conditions = ['u2', 'u3', 'u4', 'd2', 'd3', 'd4']
-    onsets = lambda event: [list(event[(event.direction == 'u') & (event.steps == 2)].onset),
-                            list(event[(event.direction == 'u') & (event.steps == 3)].onset),
-                            list(event[(event.direction == 'u') & (event.steps == 4)].onset),
-                            list(event[(event.direction == 'd') & (event.steps == 2)].onset),
-                            list(event[(event.direction == 'd') & (event.steps == 3)].onset),
-                            list(event[(event.direction == 'd') & (event.steps == 4)].onset)]
-    durations = lambda event: [list(event[(event.direction == 'u') & (event.steps == 2)].duration - 2),
-                               list(event[(event.direction == 'u') & (event.steps == 3)].duration - 2),
-                               list(event[(event.direction == 'u') & (event.steps == 4)].duration - 2),
-                               list(event[(event.direction == 'd') & (event.steps == 2)].duration - 2),
-                               list(event[(event.direction == 'd') & (event.steps == 3)].duration - 2),
-                               list(event[(event.direction == 'd') & (event.steps == 4)].duration - 2)]
-    u2_cond = ['u2','T', ['u2'], [1]]
-    d2_cond = ['d2','T', ['d2'], [1]]
-    u3_cond = ['u3','T', ['u3'], [1]]
-    d3_cond = ['d3','T', ['d3'], [1]]
-    u4_cond = ['u4','T', ['u4'], [1]]
-    d4_cond = ['d4','T', ['d4'], [1]]
-    all_nav = ['all nav', 'F', [u2_cond, d2_cond, u3_cond, d3_cond, u4_cond, d4_cond]]
-    contrasts = [u2_cond, d2_cond, u3_cond, d3_cond, u4_cond, d4_cond, all_nav]
-
-elif sys.argv[1] == 'face':
-    EXCLUDING = {4: 5}  # excluding the 6th run from the 5th subject in the above list (sub-137, run-06)
-    task = 'face'
-    num_runs = 6
-    conditions = ['no2', 'no3', 'no4', 'no5', 'no6']
-    onsets = lambda event: [list(event[event.anchor == 2].onset - 2),
-                            list(event[event.anchor == 3].onset - 2),
-                            list(event[event.anchor == 4].onset - 2),
-                            list(event[event.anchor == 5].onset - 2),
-                            list(event[event.anchor == 6].onset - 2)]
-    durations = lambda event: [list(event[event.anchor == 2].duration - 5),
-                               list(event[event.anchor == 3].duration - 5),
-                               list(event[event.anchor == 4].duration - 5),
-                               list(event[event.anchor == 5].duration - 5),
-                               list(event[event.anchor == 6].duration - 5)]
-    num2_cond = ['no2','T', ['no2'], [1]]
-    num3_cond = ['no3','T', ['no3'], [1]]
-    num4_cond = ['no4','T', ['no4'], [1]]
-    num5_cond = ['no5','T', ['no5'], [1]]
-    num6_cond = ['no6','T', ['no6'], [1]]
-    all_face = ['all face', 'F', [num2_cond, num3_cond, num4_cond, num5_cond, num6_cond]]
-    contrasts = [num2_cond, num3_cond, num4_cond, num5_cond, num6_cond, all_face]
-
-elif sys.argv[1] == 'sac':
-    task = 'sacc'
-    num_runs = 2
-    conditions = ['up', 'down', 'left', 'right']
-    onsets = lambda event: [list(event[event.direction == 'up'].onset),
-                            list(event[event.direction == 'down'].onset),
-                            list(event[event.direction == 'left'].onset),
-                            list(event[event.direction == 'right'].onset)]
-    durations = lambda event: [list(event[event.direction == 'up'].duration),
-                               list(event[event.direction == 'down'].duration),
-                               list(event[event.direction == 'left'].duration),
-                               list(event[event.direction == 'right'].duration)]
-    up_cond = ['up','T', ['up'], [1]]
-    down_cond = ['down','T', ['down'], [1]]
-    left_cond = ['left','T', ['left'], [1]]
-    right_cond = ['right','T', ['right'], [1]]
-    all_sacc = ['all sacc', 'F', [up_cond, down_cond, left_cond, right_cond]]
-    contrasts = [up_cond, down_cond, left_cond, right_cond, all_sacc]
+task = MODELS[MODEL_NAMES[0]]['task']
+num_runs = MODELS[MODEL_NAMES[0]]['num_runs']
+assert all(MODELS[name]['task'] == task and MODELS[name]['num_runs'] == num_runs for name in MODEL_NAMES), \
+    'models fitted together must share the same runs'
+
+
+def model_conditions(name):
+    return [cond for cond, _ in MODELS[name]['conditions']]
+
+
+def model_contrasts(name):
+    t_contrasts = [[cond, 'T', [cond], [1]] for cond in MODELS[name]['t_contrasts']]
+    return t_contrasts + [[MODELS[name]['f_contrast'], 'F', t_contrasts]]
+
+
+def is_excluded(name, s, r):
+    excluding = MODELS[name]['excluding']
+    return s in excluding and excluding[s] == r
+
+
+def condition_timing(event, name, shift=0.):
+    """
+    Onsets and durations of every condition of a model, from a single groupby pass over the events.
+    :param event: events DataFrame of one run
+    :param name: model name in lv1_config.MODELS
+    :param shift: seconds removed from the start of the run (dropped non-steady volumes)
+    :return: a list of onset lists and a list of duration lists, in the order of conditions
+    """
+    spec = MODELS[name]
+    groups = event.groupby(spec['group_by']).indices
+    groups = {key if isinstance(key, tuple) else (key,): rows for key, rows in groups.items()}
+    onset = event.onset.values + spec['onset_offset'] - shift
+    duration = event.duration.values + spec['duration_offset']
+    rows = [groups.get(key, []) for _, key in spec['conditions']]
+    return [list(onset[r]) for r in rows], [list(duration[r]) for r in rows]
 
 
 def get_events(func_files):
@@ -117,7 +89,7 @@ def get_events(func_files):
             else:
                 run = func_files[s][r].run
                 filename = 'sub-%s/func/sub-%s_task-%s_run-%s_events.tsv' % (subj, subj, task, run.zfill(2))
-            events[s].append(pd.read_csv(os.path.join(BIDS_DIR, filename), sep="\t"))
+            events[s].append(load_events(os.path.join(BIDS_DIR, filename)))
     return events
 
 
@@ -131,175 +103,248 @@ def get_confounds(func_files):
                 tsvname = 'sub-%s_task-%s_bold_confounds.tsv' % (func_file.subject, task)
             else:
                 tsvname = 'sub-%s_task-%s_run-%s_bold_confounds.tsv' % (func_file.subject, task, func_file.run.zfill(2))
-            confounds[s].append(pd.read_csv(os.path.join(PREPROC_DIR,
-                                                         'sub-%s' % func_file.subject,
-                                                         'func',
-                                                         tsvname),
-                                            sep="\t", na_values='n/a'))
+            confounds[s].append(load_confounds(os.path.join(PREPROC_DIR, 'sub-%s' % func_file.subject, 'func', tsvname)))
     return confounds
 
 
-def get_info(events, confounds):
-    info = []
+def get_offsets(func_files, confounds):
+    """
+    Non-steady volumes dropped from the start of every run, physically (fewer volumes in the preproc file than
+    rows in the confounds) or virtually (a trim sidecar next to the preproc file, see unsteady_volumns.py).
+    :return: offsets[s][r] = (first volume to read from the preproc file, number of volumes dropped in total),
+             None for the runs excluded from all models
+    """
+    units = set(get_units())
+    offsets = []
     for s in range(len(SUBJECTS)):
-        info.append([])
+        offsets.append([])
         for r in range(num_runs):
-            event = events[s][r]
-            info[s].append([Bunch(conditions=conditions,
-                                  onsets=onsets(event),
-                                  durations=durations(event),
-                                  regressors=[list(confounds[s][r].FramewiseDisplacement.fillna(0)),
-                                              list(confounds[s][r].aCompCor00),
-                                              list(confounds[s][r].aCompCor01),
-                                              list(confounds[s][r].aCompCor02),
-                                              list(confounds[s][r].aCompCor03),
-                                              list(confounds[s][r].aCompCor04),
-                                              list(confounds[s][r].aCompCor05),
-                                              list(confounds[s][r].X),
-                                              list(confounds[s][r].Y),
-                                              list(confounds[s][r].Z),
-                                              list(confounds[s][r].RotX),
-                                              list(confounds[s][r].RotY),
-                                              list(confounds[s][r].RotZ)],
-                                  regressor_names=['FramewiseDisplacement',
-                                                   'aCompCor00',
-                                                   'aCompCor01',
-                                                   'aCompCor02',
-                                                   'aCompCor03',
-                                                   'aCompCor04',
-                                                   'aCompCor05',
-                                                   'X',
-                                                   'Y',
-                                                   'Z',
-                                                   'RotX',
-                                                   'RotY',
-                                                   'RotZ'])])
-    return info
+            if (s, r) not in units:
+                offsets[s].append(None)
+                continue
+            preproc_file, _ = run_files(func_files[s][r])
+            first_volume = virtual_trim(preproc_file)
+            n_vols = nib.load(preproc_file).shape[3] - first_volume
+            offsets[s].append((first_volume, len(confounds[s][r]['X']) - n_vols))
+    return offsets
 
 
-def specify_model(layout, func_files, info):
-    specify_model_results = []
+def get_info(events, confounds, offsets, trs):
+    # info[s][r][model name]: subject_info of the run, with the confound regressors shared by all models
+    # events and confounds are aligned to the first volume left after dropping the non-steady volumes
+    info = []
     for s in range(len(SUBJECTS)):
-        specify_model_results.append([])
+        info.append([])
         for r in range(num_runs):
-            if s in EXCLUDING and EXCLUDING[s] == r:
+            info[s].append({})
+            if offsets[s][r] is None:  # excluded from all models
                 continue
-            func_file = func_files[s][r]
-            if num_runs == 1:
-                filename = 'sub-%s_task-%s_bold_space-T1w_preproc.nii.gz' % (func_file.subject, task)
-            else:
-                filename = 'sub-%s_task-%s_run-%s_bold_space-T1w_preproc.nii.gz' % (func_file.subject, task, func_file.run.zfill(2))
-            spec = model.SpecifyModel()
-            spec.inputs.input_units = 'secs'
-            spec.inputs.functional_runs = [os.path.join(
-                PREPROC_DIR,
-                'sub-%s' % func_file.subject,
-                'func',
-                filename
-            )]
-            spec.inputs.time_repetition = layout.get_metadata(func_files[s][r].filename)['RepetitionTime']
-            spec.inputs.high_pass_filter_cutoff = 128.
-            spec.inputs.subject_info = info[s][r]
-            specify_model_results[s].append(spec.run())
-    return specify_model_results
-
-
-def lv1_design(mem, layout, func_files, specify_model_results):
+            n_dropped = offsets[s][r][1]
+            regressors = [list(np.nan_to_num(confounds[s][r][col][n_dropped:])) for col in CONFOUNDS]
+            for name in MODEL_NAMES:
+                onsets, durations = condition_timing(events[s][r], name, n_dropped * trs[s][r])
+                info[s][r][name] = [Bunch(conditions=model_conditions(name),
+                                          onsets=onsets,
+                                          durations=durations,
+                                          regressors=regressors,
+                                          regressor_names=CONFOUNDS)]
+    return info
+
+
+def get_units():
+    # all (subject index, run index) pairs modeled by at least one of the models
+    return [(s, r) for s in range(len(SUBJECTS)) for r in range(num_runs)
+            if not all(is_excluded(name, s, r) for name in MODEL_NAMES)]
+
+
+def unit_name(s, r):
+    return 'sub-%s_run-%02d' % (SUBJECTS[s], r + 1)
+
+
+def run_files(func_file):
+    # preprocessed bold file and brain mask of a run
+    if num_runs == 1:
+        prefix = 'sub-%s_task-%s_bold_space-T1w_' % (func_file.subject, task)
+    else:
+        prefix = 'sub-%s_task-%s_run-%s_bold_space-T1w_' % (func_file.subject, task, func_file.run.zfill(2))
+    func_dir = os.path.join(PREPROC_DIR, 'sub-%s' % func_file.subject, 'func')
+    return os.path.join(func_dir, prefix + 'preproc.nii.gz'), os.path.join(func_dir, prefix + 'brainmask.nii.gz')
+
+
+def specify_model(mem, functional_run, tr, subject_info):
+    spec = mem.cache(model.SpecifyModel)
+    return spec(input_units='secs',
+                functional_runs=[functional_run],
+                time_repetition=tr,
+                high_pass_filter_cutoff=HIGH_PASS_CUTOFF,
+                subject_info=subject_info)
+
+
+def lv1_design(mem, tr, session_info, contrasts):
     level1design = mem.cache(fsl.model.Level1Design)
-    level1design_results = []
-    for s in range(len(SUBJECTS)):
-        level1design_results.append([])
-        for r in range(num_runs):
-            if s in EXCLUDING and EXCLUDING[s] == r:
-                continue
-            tr = layout.get_metadata(func_files[s][r].filename)['RepetitionTime']
-            level1design_results[s].append(level1design(
-                interscan_interval=tr,
-                bases={'dgamma': {'derivs': True}},
-                session_info=specify_model_results[s][r].outputs.session_info,
-                model_serial_correlations=True,
-                contrasts=contrasts
-            ))
-    return level1design_results
-
-
-def feat_model(mem, level1design_results):
+    return level1design(interscan_interval=tr,
+                        bases={'dgamma': {'derivs': True}},
+                        session_info=session_info,
+                        model_serial_correlations=True,
+                        contrasts=contrasts)
+
+
+def feat_model(mem, level1design_result):
     modelgen = mem.cache(fsl.model.FEATModel)
-    modelgen_results = []
-    for s in range(len(SUBJECTS)):
-        modelgen_results.append([])
-        for r in range(num_runs):
-            if s in EXCLUDING and EXCLUDING[s] == r:
-                continue
-            modelgen_results[s].append(
-                modelgen(fsf_file=level1design_results[s][r].outputs.fsf_files,
-                         ev_files=level1design_results[s][r].outputs.ev_files))
-    return modelgen_results
+    return modelgen(fsf_file=level1design_result.outputs.fsf_files,
+                    ev_files=level1design_result.outputs.ev_files)
 
 
-def masking(mem, func_files):
+def masking(mem, preproc_file, mask_file):
     mask = mem.cache(fsl.maths.ApplyMask)
-    mask_results = []
-    for s in range(len(SUBJECTS)):
-        mask_results.append([])
-        for r in range(num_runs):
-            if s in EXCLUDING and EXCLUDING[s] == r:
-                continue
-            subj = func_files[s][r].subject
-            if num_runs == 1:
-                preproc_name = 'sub-%s_task-%s_bold_space-T1w_preproc.nii.gz' % (subj, task)
-                mask_name = 'sub-%s_task-%s_bold_space-T1w_brainmask.nii.gz' % (subj, task)
-            else:
-                run = func_files[s][r].run
-                preproc_name = 'sub-%s_task-%s_run-%s_bold_space-T1w_preproc.nii.gz' % (subj, task, run.zfill(2))
-                mask_name = 'sub-%s_task-%s_run-%s_bold_space-T1w_brainmask.nii.gz' % (subj, task, run.zfill(2))
-            mask_results[s].append(
-                mask(in_file=os.path.join(PREPROC_DIR,
-                                          'sub-%s' % subj,
-                                          'func',
-                                          preproc_name),
-                     mask_file=os.path.join(PREPROC_DIR,
-                                            'sub-%s' % subj,
-                                            'func',
-                                            mask_name)))
-    return mask_results
-
-
-def film_gls(mem, mask_results, modelgen_results):
+    return mask(in_file=preproc_file, mask_file=mask_file)
+
+
+def masked_run(preproc_file, mask_file, first_volume):
+    """
+    Masked copy of a virtually trimmed run, starting at first_volume, for SpecifyModel and FILMGLS.
+    Written in-process since ApplyMask cannot skip volumes; like the ApplyMask output, it is shared by all models.
+    """
+    out_dir = os.path.join(SHARED_MEM_DIR, 'virtual_trim')
+    out_name = os.path.basename(preproc_file).replace('_preproc.', '_masked-from%d.' % first_volume)
+    out_file = os.path.join(out_dir, out_name)
+    if os.path.exists(out_file) and os.path.getmtime(out_file) >= os.path.getmtime(preproc_file):
+        return out_file
+    make_dir(out_dir)
+    img = nib.load(preproc_file)
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    header = img.header.copy()
+    header.set_data_shape(img.shape[:3] + (img.shape[3] - first_volume,))
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    dtype = header.get_data_dtype()
+
+    def blocks():
+        yield header_block(header)
+        for vol in read_volumes(img, first_volume):
+            yield volume_block(vol * mask, dtype)
+
+    return write_gzip(blocks(), out_file)
+
+
+def scans_placeholder(preproc_file, n_vols):
+    """
+    One-voxel image with the n_vols volumes of a virtually trimmed run, for SpecifyModel and Level1Design,
+    which only read the number of scans of the run, when the numpy GLM has the data in memory.
+    """
+    out_dir = os.path.join(SHARED_MEM_DIR, 'virtual_trim')
+    out_file = os.path.join(out_dir, os.path.basename(preproc_file).replace('_preproc.', '_scans-%d.' % n_vols))
+    if not os.path.exists(out_file):
+        make_dir(out_dir)
+        tmp_file = out_file.replace('.nii.gz', '.%d.tmp.nii.gz' % os.getpid())
+        nib.Nifti1Image(np.zeros((1, 1, 1, n_vols), dtype=np.float32), np.eye(4)).to_filename(tmp_file)
+        os.rename(tmp_file, out_file)
+    return out_file
+
+
+def film_gls(mem, masked_file, modelgen_result):
     filmgls = mem.cache(fsl.FILMGLS)
-    filmgls_results = []
-    for s in range(len(SUBJECTS)):
-        filmgls_results.append([])
-        for r in range(num_runs):
-            if s in EXCLUDING and EXCLUDING[s] == r:
+    return filmgls(in_file=masked_file,
+                   design_file=modelgen_result.outputs.design_file,
+                   tcon_file=modelgen_result.outputs.con_file,
+                   fcon_file=modelgen_result.outputs.fcon_file,
+                   autocorr_noestimate=True)
+
+
+def python_design(info, tr, n_vols):
+    # conditions with temporal derivatives and confounds, in the column order of the FEAT design
+    return np.column_stack([design.design_matrix(info.onsets, info.durations, tr, n_vols),
+                            np.array(info.regressors).T])
+
+
+def run_lv1(preproc_file, mask_file, tr, first_volume, model_infos):
+    """
+    Model -> design -> mask -> GLS for a single run, for each of the requested models.
+    Every run goes through the whole chain on its own, so a run never waits for the other runs between stages.
+    The masked (and for the numpy GLM, high-pass filtered) data is made once per run and shared by the models,
+    only the designs and contrasts differ.
+    :param first_volume: volumes to skip at the start of the preproc file (virtually trimmed non-steady volumes)
+    :param model_infos: list of (model name, subject_info) for the models to fit on this run
+    :return: dictionary {model name: directory of the contrast maps}
+    """
+    functional_run = preproc_file
+    if GLM_BACKEND == 'numpy':
+        # masked in memory and passed straight to the GLM, no masked copy of the run is written
+        data, mask, affine = glm.load_masked(preproc_file, mask_file, first_volume)
+        glm.highpass(data, tr, HIGH_PASS_CUTOFF)
+        if first_volume and DESIGN_BUILDER != 'python':
+            # SpecifyModel and Level1Design count the scans of the file they are given
+            functional_run = scans_placeholder(preproc_file, len(data))
+    elif first_volume:
+        # ApplyMask cannot skip volumes
+        masked_file = functional_run = masked_run(preproc_file, mask_file, first_volume)
+    else:
+        masked_file = masking(Memory(base_dir=SHARED_MEM_DIR), preproc_file, mask_file).outputs.out_file
+    results_dirs = {}
+    for name, subject_info in model_infos:
+        if GLM_BACKEND == 'numpy' and DESIGN_BUILDER == 'python':
+            design_matrix = python_design(subject_info[0], tr, data.shape[0])
+        else:
+            mem = Memory(base_dir=MEM_DIR % name)
+            specify_model_result = specify_model(mem, functional_run, tr, subject_info)
+            level1design_result = lv1_design(mem, tr, specify_model_result.outputs.session_info,
+                                             model_contrasts(name))
+            modelgen_result = feat_model(mem, level1design_result)
+            if GLM_BACKEND != 'numpy':
+                results_dirs[name] = film_gls(mem, masked_file, modelgen_result).outputs.results_dir
                 continue
-            filmgls_results[s].append(filmgls(in_file=mask_results[s][r].outputs.out_file,
-                                              design_file=modelgen_results[s][r].outputs.design_file,
-                                              tcon_file=modelgen_results[s][r].outputs.con_file,
-                                              fcon_file=modelgen_results[s][r].outputs.fcon_file,
-                                              autocorr_noestimate=True))
-    return filmgls_results
+            _, design_matrix = glm.read_vest(modelgen_result.outputs.design_file)
+        out_dir = os.path.join(MEM_DIR % name, 'numpy_glm', os.path.basename(preproc_file).split('_bold')[0])
+        results_dirs[name] = glm.run_glm(data, mask, affine, glm.highpass(design_matrix, tr, HIGH_PASS_CUTOFF),
+                                         model_contrasts(name), model_conditions(name), out_dir, ar1=PREWHITEN)
+    return results_dirs
 
 
 def main():
-    print('Running ' + sys.argv[1])
-    if not os.path.isdir(MEM_DIR):
-        os.mkdir(MEM_DIR)
-    mem = Memory(base_dir=MEM_DIR)
-    layout = BIDSLayout(BIDS_DIR)
+    print('Running %s with %d process(es)' % (', '.join(MODEL_NAMES), N_PROC))
+    for mem_dir in [MEM_DIR % name for name in MODEL_NAMES] + [SHARED_MEM_DIR]:
+        make_dir(mem_dir)
+    layout = get_layout(BIDS_DIR, LAYOUT_CACHE)
     if num_runs > 1:
         func_files = [[layout.get(type='bold', task=task, run=i+1, subject=subj, extensions='nii.gz')[0]
                        for i in range(num_runs)] for subj in SUBJECTS]
     else:
         func_files = [layout.get(type='bold', task=task, subject=subj, extensions='nii.gz') for subj in SUBJECTS]
+    trs = [[get_metadata(layout, func_file.filename)['RepetitionTime'] for func_file in runs] for runs in func_files]
     events = get_events(func_files)
     confounds = get_confounds(func_files)
-    info = get_info(events, confounds)
-    specify_model_results = specify_model(layout, func_files, info)
-    level1design_results = lv1_design(mem, layout, func_files, specify_model_results)
-    modelgen_results = feat_model(mem, level1design_results)
-    mask_results = masking(mem, func_files)
-    film_gls(mem, mask_results, modelgen_results)
+    offsets = get_offsets(func_files, confounds)
+    info = get_info(events, confounds, offsets, trs)
+    manifests = {name: load_manifest(MANIFEST % name) for name in MODEL_NAMES}
+    unit_args = {}
+    unit_hashes = {}
+    for s, r in get_units():
+        preproc_file, mask_file = run_files(func_files[s][r])
+        tr = trs[s][r]
+        first_volume = offsets[s][r][0]
+        model_infos = []
+        for name in MODEL_NAMES:
+            if is_excluded(name, s, r):
+                continue
+            digest = unit_hash([preproc_file, mask_file], tr, first_volume, [b.dictcopy() for b in info[s][r][name]],
+                               model_conditions(name), model_contrasts(name), GLM_BACKEND, DESIGN_BUILDER, PREWHITEN)
+            if not is_current(manifests[name], unit_name(s, r), digest):
+                model_infos.append((name, info[s][r][name]))
+                unit_hashes[s, r, name] = digest
+        if model_infos:
+            unit_args[s, r] = (preproc_file, mask_file, tr, first_volume, model_infos)
+    print('%d of %d runs to (re)compute:' % (len(unit_args), len(get_units())))
+    for s, r in sorted(unit_args):
+        print('  %s: %s' % (unit_name(s, r), ', '.join(name for name, _ in unit_args[s, r][-1])))
+    if DRY_RUN or not unit_args:
+        return
+    results = run_units('Level 1', run_lv1, unit_args, N_PROC, lambda unit: unit_name(*unit))
+    for name in MODEL_NAMES:
+        manifest = load_manifest(MANIFEST % name)
+        for unit, results_dirs in results.items():
+            if name in results_dirs:
+                manifest[unit_name(*unit)] = {'hash': unit_hashes[unit + (name,)], 'output': results_dirs[name]}
+        save_manifest(MANIFEST % name, manifest)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Level 2: per-subject stacks of the run-wise level 1 t stats, as input to the MVPA searchlights.
+
+The T contrast t stats of every modeled run (found through the level 1 manifest) are written
+as one 4D file per subject, TSTATS_DIR/<stack>_tstats/sub-<subject>_<stack>.nii.gz, with one
+volume per run and contrast.  TSTATS_DIR/<stack>_attr.txt holds the "target chunk" line of
+every volume; subjects with excluded runs get their own <stack>_attr_<subject>.txt.
+
+Volumes are read and compressed into the output one at a time (nifti_stream.py), so a stack
+is never held in memory as a whole.  Subjects whose stack is newer than all of its t stats are skipped.
+
+Usage: python post_fmriprep_lv2.py <model name>[,<model name>...] [n processes]
+"""
+
+import os
+import sys
+import numpy as np
+import nibabel as nib
+from manifest import load_manifest
+from nifti_stream import write_gzip, header_block, volume_block
+from lv1_config import MODELS, SUBJECTS
+from units import make_dir, run_units
+
+# Path
+MANIFEST = '/u/project/cparkins/data/hierarchy/derivatives/lv1/work/%s/manifest.json'  # level 1 manifest per model
+TSTATS_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/tstats/'
+# Execution
+N_PROC = int(sys.argv[2]) if len(sys.argv) > 2 else 1  # number of subjects stacked in parallel
+# Stacks: file name and volumes of every run, as (T contrast, target label), in the order the MVPA labels expect.
+# Models not listed are stacked as <model name with _> with their T contrasts as targets.
+STACKS = {
+    'nav-bin': {'name': 'nav_bin', 'volumes': [('d', 'down'), ('u', 'up')]},
+    'sac': {'name': 'sac', 'volumes': [('down', 'eye_down'), ('left', 'eye_left'),
+                                       ('right', 'eye_right'), ('up', 'eye_up')]},
+}
+
+
+def stack_spec(name):
+    if name in STACKS:
+        return STACKS[name]
+    return {'name': name.replace('-', '_'), 'volumes': [(con, con) for con in MODELS[name]['t_contrasts']]}
+
+
+def stack_runs(name, s):
+    # run indices of subject s in the model
+    excluding = MODELS[name]['excluding']
+    return [r for r in range(MODELS[name]['num_runs']) if not (s in excluding and excluding[s] == r)]
+
+
+def attr_lines(name, runs):
+    return ['%s %d\n' % (target, r + 1) for r in runs for _, target in stack_spec(name)['volumes']]
+
+
+def tstat_files(name, manifest, s):
+    # t stat file of every volume in the stack of subject s, None if a run has no level 1 result
+    t_contrasts = MODELS[name]['t_contrasts']
+    files = []
+    for r in stack_runs(name, s):
+        entry = manifest.get('sub-%s_run-%02d' % (SUBJECTS[s], r + 1))
+        if entry is None:
+            return None
+        files += [os.path.join(entry['output'], 'tstat%d.nii.gz' % (t_contrasts.index(con) + 1))
+                  for con, _ in stack_spec(name)['volumes']]
+    return files
+
+
+def is_current(out_file, in_files):
+    return os.path.exists(out_file) and os.path.getmtime(out_file) >= max(os.path.getmtime(f) for f in in_files)
+
+
+def write_stack(in_files, out_file):
+    """
+    Concatenate 3D images into a 4D .nii.gz, streaming one volume at a time.
+    :param in_files: 3D images with the same shape and affine
+    :param out_file: 4D output file (written to a temporary file first, then renamed)
+    """
+    first = nib.load(in_files[0])
+    header = first.header.copy()
+    header.set_data_shape(first.shape + (len(in_files),))
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    dtype = header.get_data_dtype()
+
+    def blocks():
+        yield header_block(header)
+        for filename in in_files:
+            img = nib.load(filename)
+            assert img.shape == first.shape and np.allclose(img.affine, first.affine), \
+                '%s does not match %s' % (filename, in_files[0])
+            yield volume_block(img.dataobj, dtype)
+
+    return write_gzip(blocks(), out_file)
+
+
+def main(model_names):
+    jobs = {}
+    for name in model_names:
+        spec = stack_spec(name)
+        out_dir = TSTATS_DIR + '%s_tstats/' % spec['name']
+        make_dir(out_dir)
+        with open(TSTATS_DIR + '%s_attr.txt' % spec['name'], 'w') as outfile:
+            outfile.writelines(attr_lines(name, range(MODELS[name]['num_runs'])))
+        manifest = load_manifest(MANIFEST % name)
+        for s, subj in enumerate(SUBJECTS):
+            runs = stack_runs(name, s)
+            if len(runs) < MODELS[name]['num_runs']:
+                with open(TSTATS_DIR + '%s_attr_%s.txt' % (spec['name'], subj), 'w') as outfile:
+                    outfile.writelines(attr_lines(name, runs))
+            in_files = tstat_files(name, manifest, s)
+            if in_files is None:
+                print('%s sub-%s: missing level 1 runs, skipped' % (name, subj))
+                continue
+            out_file = out_dir + 'sub-%s_%s.nii.gz' % (subj, spec['name'])
+            if not is_current(out_file, in_files):
+                jobs['%s sub-%s' % (name, subj)] = (in_files, out_file)
+    print('%d stack(s) to write with %d process(es)' % (len(jobs), N_PROC))
+    if jobs:
+        run_units('Level 2', write_stack, jobs, N_PROC)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1].split(','))
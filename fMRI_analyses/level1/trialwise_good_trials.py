@@ -1,55 +1,112 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+"""
+Table of every trialwise sample: (subject, task, run, trial_order, correct, nonsteady_count),
+one row per trial in the order of the trialwise attr files, saved as typed columns in OUTFILE.
+
+Rows are sorted by subject and task, and the (subject, task) -> rows index is saved with
+the table (index_keys 'sub-132/nav', index_bounds [start, stop)), so a consumer gets all
+trials of a subject/task as one slice.  nonsteady_count is the number of non-steady volumes
+overlapping the first trial of the run, 0 for all other trials.
+
+Usage: python trialwise_good_trials.py [n processes]
+       python trialwise_good_trials.py --from-pickle good_trials.pkl   (convert the old nested dict)
+"""
+
 import pandas as pd
+import numpy as np
+import multiprocessing
 import os
 import pickle as pkl
+import sys
+from tsv_store import load_events
 
 # Path
 BIDS_DIR = '/u/project/cparkins/data/hierarchy/'
 ATTR_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/tstats/'
 TASK_RUNS = {'nav': 6, 'sacc': 2}
-OUTFILE = '/u/project/cparkins/data/hierarchy/derivatives/lv1/good_trials.pkl'
+OUTFILE = '/u/project/cparkins/data/hierarchy/derivatives/lv1/good_trials.npz'
+N_PROC = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 1  # subjects read in parallel
+
+
+def task_attrs(task):
+    # event directions in the order of the trialwise attr file
+    attr_file = ATTR_DIR + ('sac' if task == 'sacc' else task) + '_trialwise_attr_bin.txt'
+    attrs = pd.read_csv(attr_file, sep=' ', header=None)[0].unique()
+    if task == 'sacc':
+        return [attr[4:] for attr in attrs]  # 'eye_up' -> 'up'
+    return [attr[0] for attr in attrs]       # 'up' -> 'u'
+
+
+def subject_trials(job):
+    # rows (task, run, trial_order, correct, nonsteady_count) of all trials of a subject
+    subj, nonsteady, attrs = job
+    rows = []
+    for task in sorted(TASK_RUNS):
+        task_fname = 'face' if task == 'nav' else task
+        for run in range(1, TASK_RUNS[task] + 1):
+            # get event file
+            fname = BIDS_DIR + subj + '/func/%s_task-%s_run-0%d_events.tsv' % (subj, task_fname, run)
+            events = load_events(fname)
+            # reorder events based on attributes
+            ord_events = pd.concat([events[events['direction'] == attr] for attr in attrs[task]])
+            if len(ord_events) == 0:
+                print(subj, task, run, attrs[task], events)
+            correct = ord_events.correct.values.astype(bool) if task == 'nav' else np.ones(len(ord_events), bool)
+            nonsteady_count = np.zeros(len(ord_events), dtype=np.int16)
+            nonsteady_count[ord_events.index.get_loc(0)] = nonsteady[task_fname + str(run).zfill(2)]
+            rows += zip([task] * len(ord_events), [run] * len(ord_events), range(len(ord_events)),
+                        correct, nonsteady_count)
+    return subj, rows
+
+
+def pickle_trials(pkl_file):
+    # rows of the old {task: {subj: {run: [correct, or the first trial's non-steady count]}}} pickle
+    with open(pkl_file, 'rb') as infile:
+        info = pkl.load(infile, encoding='latin1')
+    results = {}
+    for task in sorted(info):
+        for subj in info[task]:
+            for run in sorted(info[task][subj]):
+                for i, val in enumerate(info[task][subj][run]):
+                    count = 0 if isinstance(val, (bool, np.bool_)) else int(val)
+                    results.setdefault(subj, []).append((task, run, i, bool(val), count))
+    return results
+
+
+def save_table(results, filename):
+    # columns sorted by subject, then task, run and trial order
+    rows = [(subj,) + tuple(row) for subj in sorted(results) for row in results[subj]]
+    subject, task, run, trial_order, correct, nonsteady_count = zip(*rows)
+    keys = np.char.add(np.char.add(np.array(subject), '/'), np.array(task))
+    index_keys, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    print('%d trials of %d subjects, %d marked incorrect, %d first trials with non-steady volumes'
+          % (len(keys), len(results), len(correct) - sum(correct), np.count_nonzero(nonsteady_count)))
+    tmp_file = filename + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'wb') as outfile:
+        np.savez_compressed(outfile,
+                 subject=np.array(subject), task=np.array(task), run=np.array(run, dtype=np.int8),
+                 trial_order=np.array(trial_order, dtype=np.int16), correct=np.array(correct, dtype=bool),
+                 nonsteady_count=np.array(nonsteady_count, dtype=np.int16),
+                 index_keys=index_keys, index_bounds=np.column_stack([starts, starts + counts]))
+    os.rename(tmp_file, filename)
+
 
 def main():
+    if '--from-pickle' in sys.argv:
+        pkl_file = sys.argv[sys.argv.index('--from-pickle') + 1]
+        save_table(pickle_trials(pkl_file), os.path.splitext(pkl_file)[0] + '.npz')
+        return
     nonsteady = pd.read_csv('unsteady_vols.csv', index_col=0)
-    subjects = nonsteady.index.tolist()
-    trials = {}
-    for task in TASK_RUNS:
-        trials[task] = {}
-        # trial attributes
-        task_fname = 'face' if task == 'nav' else task
-        attr_file = ATTR_DIR + ('sac' if task == 'sacc' else task) + '_trialwise_attr_bin.txt'
-        attrs = pd.read_csv(attr_file, sep=' ', header=None)[0].unique()
-        if task == 'sacc':
-            attrs = [attr[4:] for attr in attrs]  # 'eye_up' -> 'up'
-        elif task == 'nav':
-            attrs = [attr[0] for attr in attrs]   # 'up' -> 'u'
-        for subj in subjects:
-            trials[task][subj] = {}
-            for run in range(1, TASK_RUNS[task] + 1):
-                # get event file
-                fname = BIDS_DIR + subj + '/func/%s_task-%s_run-0%d_events.tsv' % (subj, task_fname, run)
-                events = pd.read_csv(fname, sep='\t')
-                # reorder events based on attributes
-                col = 'direction'
-                ord_events = pd.concat([events[events[col] == attr] for attr in attrs])
-                if len(ord_events) == 0:
-                    print(subj, task, run, attrs, events)
-                trial1_index = ord_events.index.get_loc(0)
-                # correct
-                if task == 'nav':
-                    trial_bools = list(ord_events.correct)
-                else:
-                    trial_bools = [True] * len(ord_events)
-                # steady
-                n_trial1_nonsteady = nonsteady[task_fname + str(run).zfill(2)][subj]
-                if n_trial1_nonsteady > 0:
-                    trial_bools[trial1_index] = n_trial1_nonsteady
-                trials[task][subj][run] = trial_bools
-    print(trials)
-    with open(OUTFILE, 'wb') as pkl_file:
-        pkl.dump(trials, pkl_file, protocol=2)
+    attrs = {task: task_attrs(task) for task in TASK_RUNS}
+    jobs = [(subj, nonsteady.loc[subj], attrs) for subj in sorted(nonsteady.index)]
+    pool = multiprocessing.Pool(N_PROC)
+    results = dict(pool.imap_unordered(subject_trials, jobs))
+    pool.close()
+    pool.join()
+    save_table(results, OUTFILE)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Trialwise t-stat maps by least-squares-separate (LSS) for the classification searchlights.
+
+Every trial gets its own model (that trial + all other trials + nuisance).  The nuisance
+regressors (confounds, cosine drift, constant) are the same in all of those models, so they
+are projected out of the data and the trial regressors once, and each trial's 2-regressor fit
+is solved from the shared cross products instead of refitting the whole GLM N times.
+
+Writes TSTATS_DIR/<name>_trialwise_tstats/<subject file> and its attributes, one "target run"
+line per volume, in <name>_trialwise_attr_bin.txt, the file shared by all subjects that the
+MVPA scripts read.  A subject whose trials differ from the shared file gets its own
+<name>_trialwise_attr_bin_<subject number>.txt, which the MVPA scripts read instead.
+
+Usage: python trialwise_lss.py nav|sac sub-132 sub-133 ...
+"""
+
+import os
+import sys
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from design import design_matrix, dct_basis
+from glm import VOXEL_CHUNK, load_masked
+from tsv_store import CONFOUNDS, load_confounds, load_events
+from nifti_stream import virtual_trim
+from bids_cache import get_layout, get_metadata
+from units import make_dir
+
+# Path
+BIDS_DIR = '/u/project/cparkins/data/hierarchy/'
+PREPROC_DIR = '/u/project/cparkins/data/hierarchy/fmriprep/output/fmriprep/'
+TSTATS_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/tstats/'
+LAYOUT_CACHE = '/u/project/cparkins/data/hierarchy/derivatives/lv1/work/bids_layout.pkl'  # as post_fmriprep_lv1
+# Models
+HIGH_PASS_CUTOFF = 128.
+TRIALWISE = {
+    'nav': {'task': 'face', 'runs': 6, 'duration_offset': -2, 'outfile': '%s_nav.nii.gz',
+            'labels': [('u', 'up'), ('d', 'down')]},
+    'sac': {'task': 'sacc', 'runs': 2, 'duration_offset': 0, 'outfile': '%s_sac_trialwise.nii.gz',
+            'labels': [('up', 'eye_up'), ('down', 'eye_down'), ('left', 'eye_left'), ('right', 'eye_right')]},
+}
+
+
+def lss(data, trials, nuisance):
+    """
+    Least-squares-separate estimates for all trials.
+    :param data: time x voxel array
+    :param trials: time x trial array, one convolved regressor per trial
+    :param nuisance: time x regressor array shared by every trial model (should include a constant)
+    :return: betas and t statistics, both trial x voxel
+    """
+    pinv = np.linalg.pinv(nuisance)
+    x = trials - nuisance.dot(pinv.dot(trials))
+    dof = data.shape[0] - np.linalg.matrix_rank(nuisance) - 2
+    # trial i is fitted with x_i and o_i = (sum of all trials) - x_i, so every dot product
+    # of the 2x2 normal equations comes from the shared x'x and x'y
+    xx = x.T.dot(x)
+    a = np.diag(xx)                             # x_i . x_i
+    b = xx.sum(axis=1) - a                      # x_i . o_i
+    c = xx.sum() - 2 * xx.sum(axis=1) + a       # o_i . o_i
+    det = a * c - b * b
+    betas = np.empty((x.shape[1], data.shape[1]))
+    tstats = np.empty((x.shape[1], data.shape[1]))
+    for start in range(0, data.shape[1], VOXEL_CHUNK):
+        y = np.asarray(data[:, start:start + VOXEL_CHUNK], dtype=np.float64)
+        y = y - nuisance.dot(pinv.dot(y))
+        xy = x.T.dot(y)                         # x_i . y
+        oy = xy.sum(axis=0) - xy                # o_i . y
+        beta = (c[:, None] * xy - b[:, None] * oy) / det[:, None]
+        beta_other = (a[:, None] * oy - b[:, None] * xy) / det[:, None]
+        rss = np.einsum('tv,tv->v', y, y)[None, :] - beta * xy - beta_other * oy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = beta / np.sqrt(rss / dof * (c / det)[:, None])
+        betas[:, start:start + VOXEL_CHUNK] = beta
+        tstats[:, start:start + VOXEL_CHUNK] = np.nan_to_num(t)
+    return betas, tstats
+
+
+def run_trials(layout, subj, config, run):
+    # LSS t stats of one run, with trials ordered by label and then by onset
+    prefix = '%s_task-%s_run-%s' % (subj, config['task'], str(run).zfill(2))
+    func_dir = os.path.join(PREPROC_DIR, subj, 'func')
+    # TR through the layout, which applies BIDS inheritance (e.g. a top-level task-*_bold.json)
+    tr = get_metadata(layout, os.path.join(BIDS_DIR, subj, 'func', prefix + '_bold.nii.gz'))['RepetitionTime']
+    events = load_events(os.path.join(BIDS_DIR, subj, 'func', prefix + '_events.tsv'))
+    confounds = load_confounds(os.path.join(func_dir, prefix + '_bold_confounds.tsv'))
+    preproc_file = os.path.join(func_dir, prefix + '_bold_space-T1w_preproc.nii.gz')
+    data, mask, affine = load_masked(preproc_file, os.path.join(func_dir, prefix + '_bold_space-T1w_brainmask.nii.gz'),
+                                     virtual_trim(preproc_file))
+    n_vols = data.shape[0]
+    # non-steady volumes removed from (or skipped in) the preproc file are still in the confounds and event times
+    n_dropped = len(confounds['X']) - n_vols
+    confounds = np.nan_to_num(np.column_stack([confounds[name] for name in CONFOUNDS]))[n_dropped:]
+    events = events[events.direction.isin([d for d, _ in config['labels']])]
+    order = pd.concat([events[events.direction == d] for d, _ in config['labels']])
+    onsets = order.onset.values - n_dropped * tr
+    durations = order.duration.values + config['duration_offset']
+    trials = design_matrix([[o] for o in onsets], [[d] for d in durations], tr, n_vols, derivs=False)
+    nuisance = np.column_stack([confounds, dct_basis(tr, n_vols, HIGH_PASS_CUTOFF)])  # drift basis includes the mean
+    _, tstats = lss(data, trials, nuisance)
+    labels = dict(config['labels'])
+    targets = [labels[d] for d in order.direction]
+    return affine, mask, tstats, targets
+
+
+def write_attr(name, subj, attr_lines):
+    # shared attr file if the subject's trials match it (or it does not exist yet), else the subject's own file
+    shared_file = TSTATS_DIR + '%s_trialwise_attr_bin.txt' % name
+    subject_file = TSTATS_DIR + '%s_trialwise_attr_bin_%s.txt' % (name, subj[4:])
+    if not os.path.exists(shared_file):
+        with open(shared_file, 'w') as outfile:
+            outfile.writelines(attr_lines)
+    with open(shared_file) as infile:
+        shared = infile.readlines()
+    if shared == attr_lines:
+        if os.path.exists(subject_file):
+            os.remove(subject_file)
+        return shared_file
+    with open(subject_file, 'w') as outfile:
+        outfile.writelines(attr_lines)
+    return subject_file
+
+
+def main(name, subjects):
+    config = TRIALWISE[name]
+    out_dir = TSTATS_DIR + '%s_trialwise_tstats/' % name
+    make_dir(out_dir)
+    layout = get_layout(BIDS_DIR, LAYOUT_CACHE)
+    for subj in subjects:
+        print('Running %s %s' % (name, subj))
+        volumes = []
+        attr_lines = []
+        for run in range(1, config['runs'] + 1):
+            affine, mask, tstats, targets = run_trials(layout, subj, config, run)
+            for values, target in zip(tstats, targets):
+                vol = np.zeros(mask.shape, dtype=np.float32)
+                vol[mask] = values
+                volumes.append(vol)
+                attr_lines.append('%s %d\n' % (target, run))
+        nib.Nifti1Image(np.stack(volumes, axis=-1), affine).to_filename(out_dir + config['outfile'] % subj)
+        print('Attributes in %s' % write_attr(name, subj, attr_lines))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,94 @@
+"""
+Columnar store of fMRIPrep confounds and BIDS events.
+
+Each TSV is read with pandas once, and the columns that are used are saved as typed
+arrays in STORE_DIR/<tsv name>.npz.  Later loads read the .npz arrays and close the file.
+True/false columns with n/a values are stored as 1/0/nan floats, not as strings, and the
+n/a cells of text columns are stored as a mask and come back as NaN, as from read_csv.
+A stored file is rebuilt only when its TSV was modified (size or mtime changed) or it was
+written by an older STORE_VERSION, so new or re-run fMRIPrep outputs are picked up incrementally.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from units import make_dir
+
+STORE_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/store/'
+# confound regressors of the level 1 models
+CONFOUNDS = ['FramewiseDisplacement', 'aCompCor00', 'aCompCor01', 'aCompCor02', 'aCompCor03', 'aCompCor04',
+             'aCompCor05', 'X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ']
+CONFOUND_PREFIXES = ('NonSteadyStateOutlier',)
+STORE_VERSION = 3  # stored files of an older version are rebuilt
+MISSING = '__missing__'  # prefix of the n/a masks of text columns
+
+
+def _stamp(tsv_file):
+    stat = os.stat(tsv_file)
+    return np.array([stat.st_size, stat.st_mtime, STORE_VERSION])
+
+
+def _column(values):
+    # typed array of a column: numbers and booleans as they are, true/false with n/a as floats, others as strings
+    if values.dtype.kind in 'biuf':
+        return values
+    present = values[~pd.isnull(values)]
+    if len(present) and all(isinstance(value, (bool, np.bool_)) for value in present):
+        return values.astype(float)
+    return values.astype(str)
+
+
+def _ingest(tsv_file, npz_file, keep):
+    df = pd.read_csv(tsv_file, sep='\t', na_values='n/a', usecols=keep)  # unused columns are not parsed
+    columns = {col: _column(df[col].to_numpy()) for col in df.columns}
+    for col in df.columns:
+        if columns[col].dtype.kind == 'U' and df[col].isnull().any():
+            columns[MISSING + col] = df[col].isnull().to_numpy()
+    make_dir(STORE_DIR)
+    tmp_file = npz_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'wb') as outfile:
+        np.savez(outfile, __stamp__=_stamp(tsv_file), __columns__=np.array(list(df.columns), dtype=str), **columns)
+    os.rename(tmp_file, npz_file)
+
+
+def _restore_missing(store):
+    # put NaN back in the n/a cells of the text columns
+    for key in [key for key in store if key.startswith(MISSING)]:
+        col = key[len(MISSING):]
+        store[col] = store[col].astype(object)
+        store[col][store.pop(key)] = np.nan
+    return store
+
+
+def load(tsv_file, keep=lambda col: True):
+    """
+    Columns of a TSV file from the store, ingesting the TSV first if it is new or changed.
+    :param tsv_file: path of the TSV file
+    :param keep: function telling whether a column should be stored
+    :return: {column name: array}, with the column names in `__columns__`; text columns with n/a cells are
+             object arrays holding NaN in those cells
+    """
+    npz_file = os.path.join(STORE_DIR, os.path.basename(tsv_file)[:-len('.tsv')] + '.npz')
+    if os.path.exists(npz_file):
+        with np.load(npz_file) as store:
+            if np.array_equal(store['__stamp__'], _stamp(tsv_file)):
+                return _restore_missing(dict(store))
+    _ingest(tsv_file, npz_file, keep)
+    with np.load(npz_file) as store:
+        return _restore_missing(dict(store))
+
+
+def load_confounds(tsv_file):
+    # CONFOUNDS and non-steady-state outlier columns of an fMRIPrep confounds.tsv, as float arrays
+    return load(tsv_file, lambda col: col in CONFOUNDS or col.startswith(CONFOUND_PREFIXES))
+
+
+def confound_columns(confounds, prefix):
+    # names of the stored confound columns starting with prefix
+    return [col for col in confounds['__columns__'] if col.startswith(prefix)]
+
+
+def load_events(tsv_file):
+    # a BIDS events.tsv as a DataFrame
+    store = load(tsv_file)
+    return pd.DataFrame({col: store[col] for col in store['__columns__']}, columns=list(store['__columns__']))
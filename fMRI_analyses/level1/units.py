@@ -0,0 +1,63 @@
+"""
+Process pool for the per-unit jobs of the level 1 / level 2 scripts (runs, subject stacks, trims),
+and the creation of the directories those jobs (and concurrent invocations) share.
+
+Units are handed out one at a time, so a worker picks up the next unit as soon as it is free.
+A unit that fails is reported with its traceback and left out of the results, and the other
+units keep running.
+"""
+
+import multiprocessing
+import os
+import traceback
+
+
+def make_dir(path):
+    # makedirs that tolerates another unit creating the directory at the same time
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _run_unit(job):
+    unit, func, args = job
+    try:
+        return unit, func(*args), None
+    except Exception:
+        return unit, None, traceback.format_exc()
+
+
+def run_units(stage, func, unit_args, n_proc, name=str):
+    """
+    Run func for every unit, across a pool of n_proc worker processes.
+    :param stage: name shown in the progress messages
+    :param func: module-level function that processes one unit
+    :param unit_args: dictionary {unit: tuple of arguments to func}
+    :param n_proc: number of worker processes (1: run in this process)
+    :param name: function giving the name of a unit in the messages
+    :return: dictionary {unit: result of func} for the units that succeeded
+    """
+    jobs = [(unit, func, unit_args[unit]) for unit in sorted(unit_args)]
+    if n_proc > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(n_proc, len(jobs)))
+        outputs = pool.imap_unordered(_run_unit, jobs)
+    else:
+        pool = None
+        outputs = map(_run_unit, jobs)
+    results = {}
+    failed = []
+    for i, (unit, result, error) in enumerate(outputs):
+        if error is None:
+            results[unit] = result
+            print('%s [%d/%d] %s done' % (stage, i + 1, len(jobs), name(unit)))
+        else:
+            failed.append(unit)
+            print('%s [%d/%d] %s FAILED\n%s' % (stage, i + 1, len(jobs), name(unit), error))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if failed:
+        print('%s failed for: %s' % (stage, ', '.join(name(unit) for unit in failed)))
+    return results
@@ -1,65 +1,95 @@
 """
 Detect the initial unsteady volumns in confounds.tsv, and
 remove those initial volumns from preproc files.
-Also check for big movements and print the info.
+Also check for big movements and print the info (motion_qc.py).
 
 The original preproc file will be renamed as "unsteady_" +
 original name, and the processed file will be named same as
 the original preproc file name.
 If no unsteady state is present in confounds.tsv, the file
-remains unchanged.
+remains unchanged.  A run whose "unsteady_" file already
+exists was trimmed before and is left alone.
 
-Load fsl/5.0.10 before running this.
+The volumns are removed in-process (nifti_stream.trim_volumes),
+with the runs split across a pool of worker processes.
+
+With --virtual, the preproc files are not rewritten: the number
+of unsteady volumns is written to a <preproc name>_trim.json
+sidecar, and the level 1 loaders skip those volumns on read.
+
+Usage: python unsteady_volumns.py [n processes] [--virtual]
 """
 
 import os
+import sys
+import json
 import pandas as pd
-import subprocess
-import re
+import nibabel as nib
+from motion_qc import scan
+from nifti_stream import trim_volumes, trim_sidecar, write_virtual_trim
+from units import run_units
 
 PATH = '../fmriprep/'
 PREPROC_POSTFIX = 'space-T1w_preproc.nii.gz'  # things after "bold_"
-XYZ_MOVEMENT_CRITERION = 2.5  # if larger than this, will just print the info and nothing else
+ARGV = [arg for arg in sys.argv if not arg.startswith('--')]
+N_PROC = int(ARGV[1]) if len(ARGV) > 1 else 1  # number of runs trimmed in parallel
+VIRTUAL_TRIM = '--virtual' in sys.argv  # record the volumns to skip instead of rewriting the preproc files
+
+
+def trim_run(filepath, preproc_name, num_unsteady):
+    # write the trimmed run next to the original, then swap the names
+    unsteady_name = 'unsteady_' + preproc_name
+    trimmed_name = 'trimmed_' + preproc_name
+    trim_volumes(nib.load(filepath + preproc_name), filepath + trimmed_name, num_unsteady)
+    os.rename(filepath + preproc_name, filepath + unsteady_name)
+    os.rename(filepath + trimmed_name, filepath + preproc_name)
+    if os.path.exists(trim_sidecar(filepath + preproc_name)):
+        os.remove(trim_sidecar(filepath + preproc_name))  # a virtual trim would now skip too many volumns
+
 
-all_rows = set()
-unsteady_df = {}
-subjects = [f[:7] for f in os.listdir(PATH) if f.endswith('.html') and f.startswith('sub')]
-for subj in subjects:
-    unsteady_df[subj] = {}
-    filepath = PATH + subj + '/func/'
-    filenames = [f for f in os.listdir(filepath)
-                 if f.startswith('sub') and f.endswith('confounds.tsv')]
-    for fname in sorted(filenames):
-        df = pd.read_csv(filepath + fname, sep='\t')
-        # look at XYZ axis movement
-        for axis in ('X', 'Y', 'Z'):
-            big_move = list(df[axis][df[axis] > XYZ_MOVEMENT_CRITERION])
-            if len(big_move) > 0:
-                print('Big movements in %s, %s axis:' % (fname, axis), big_move)
-        # find unsteady rows
-        cols = [c for c in df.columns if c.startswith('NonSteadyStateOutlier')]
-        unsteady = df[cols].sum(axis=1)
-        unsteady_rows = list(unsteady[unsteady == 1].index)
-        num_unsteady = len(unsteady_rows)
-        all_rows.update(unsteady_rows)
-        print(fname + '\trows=' + str(unsteady_rows))
+def main():
+    all_rows = set()
+    unsteady_df = {}
+    jobs = {}
+    # motion and non-steady summaries of all runs, from a thread pool over the confounds
+    for _, qc in scan(PATH).iterrows():
+        subj, fname = qc.subject, qc.file
+        filepath = PATH + subj + '/func/'
+        unsteady_df.setdefault(subj, {})
+        if qc.big_moves > 0:
+            print('Big movements in %s: %d volumes, max X/Y/Z %.2f %.2f %.2f'
+                  % (fname, qc.big_moves, qc.max_X, qc.max_Y, qc.max_Z))
+        num_unsteady = qc.nonsteady
+        all_rows.update(json.loads(qc.nonsteady_rows))
+        print(fname + '\trows=' + qc.nonsteady_rows)
         # update df
-        task = re.findall(r'_task-[^_]+_', fname)[0][6:-1]
-        run = re.findall(r'_run-\d+_', fname)
-        col_name = task + run[0][5:-1] if len(run) > 0 else task
-        unsteady_content = num_unsteady if unsteady_rows == list(range(num_unsteady)) else str(unsteady_rows)
-        unsteady_df[subj][col_name] = unsteady_content
+        col_name = '%s%02d' % (qc.task, qc.run) if qc.run else qc.task
+        unsteady_df[subj][col_name] = num_unsteady if qc.leading_nonsteady == num_unsteady else qc.nonsteady_rows
         if num_unsteady == 0:
             continue
 
         # remove first columns from preproc file
         preproc_name = fname[:fname.index('confounds.tsv')] + PREPROC_POSTFIX
-        unsteady_name = 'unsteady_' + preproc_name
-        print('Removing first %d volumns from ' % num_unsteady + preproc_name)
-        os.rename(filepath + preproc_name, filepath + unsteady_name)
-        subprocess.call('cd %s; fslroi %s %s %d -1' % (filepath, unsteady_name, preproc_name, num_unsteady), shell=True)
+        if os.path.exists(filepath + 'unsteady_' + preproc_name):
+            unsteady_df[subj][col_name + '_trim'] = 'trimmed before'
+            continue
+        if VIRTUAL_TRIM:
+            write_virtual_trim(filepath + preproc_name, num_unsteady)
+            unsteady_df[subj][col_name + '_trim'] = 'virtual'
+            continue
+        jobs[subj, col_name] = (filepath, preproc_name, num_unsteady)
+
+    print('all unsteady rows:', all_rows)
+    print('Trimming %d runs with %d process(es)' % (len(jobs), N_PROC))
+    trimmed = run_units('Trimming', trim_run, jobs, N_PROC, lambda unit: '%s %s' % unit)
+    for (subj, col_name), (_, preproc_name, num_unsteady) in sorted(jobs.items()):
+        if (subj, col_name) in trimmed:
+            print('Removed first %d volumns from %s' % (num_unsteady, preproc_name))
+        unsteady_df[subj][col_name + '_trim'] = 'trimmed' if (subj, col_name) in trimmed else 'failed'
+    # df output
+    unsteady_df = pd.DataFrame.from_dict(unsteady_df, orient='index')
+    unsteady_df.to_csv('unsteady_vols.csv')
+
 
-print('all unsteady rows:', all_rows)
-# df output
-unsteady_df = pd.DataFrame.from_dict(unsteady_df, orient='index')
-unsteady_df.to_csv('unsteady_vols.csv')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Batched cross-validated classifier for the classification searchlights, an alternative to
+CrossValidation(LinearCSVMC(), ...) in sphere_searchlight.
+
+The classifier is a correlation-distance nearest centroid: a test sample gets the target whose
+training centroid (mean of the training samples of that target) it correlates best with over the
+sphere's features.  Its solution is closed-form, so all spheres are classified at once: as in
+rsa_kernel.py, the correlation of a test sample x with a centroid c over a sphere of k features
+follows from the sphere sums of x, x ** 2, c, c ** 2 and x * c, obtained for a block of spheres
+as one sparse product (searchlight.sphere_matrix).
+
+Folds leave out one value of a sample attribute at a time, in sorted order, as NFoldPartitioner()
+does on chunks and HalfPartitioner(attr='modality') on two modalities, and the result has one
+row of test accuracies (mean(predictions == targets)) per fold, as CrossValidation.  Several
+radii are classified in one pass, as in rsa_kernel.py.
+"""
+
+import numpy as np
+from searchlight import as_indexes, nested_shells, nested_sums, run_blocks, searchlight_maps, BLOCK_SIZE
+
+
+def test_folds(partition):
+    # fold of every sample, the fold tested on it (index into the sorted values of the partition attribute)
+    return np.unique(np.asarray(partition), return_inverse=True)[1]
+
+
+def centroid_values(samples, targets, folds):
+    """
+    :param samples: samples x features array
+    :param targets: target of every sample
+    :param folds: test fold of every sample (test_folds)
+    :return: features x columns of x, x ** 2, c, c ** 2 and x * c (test samples x targets), target indices
+    """
+    x = np.asarray(samples, dtype=np.float64)
+    classes, y = np.unique(np.asarray(targets), return_inverse=True)
+    n_folds = folds.max() + 1
+    with np.errstate(invalid='ignore'):
+        c = np.array([[x[(folds != fold) & (y == k)].mean(axis=0) for k in range(len(classes))]
+                      for fold in range(n_folds)])  # folds x targets x features
+    xc = x[:, None, :] * c[folds]
+    n_centroids = n_folds * len(classes)
+    return np.hstack([x.T, (x ** 2).T, c.reshape(n_centroids, -1).T, (c ** 2).reshape(n_centroids, -1).T,
+                      xc.reshape(len(x) * len(classes), -1).T]), y
+
+
+def fold_accuracy(sums, sizes, y, folds, n_classes):
+    """
+    Accuracies of the folds, from the sphere sums of centroid_values.
+    :return: spheres x folds array
+    """
+    n_samples = len(y)
+    n_folds = folds.max() + 1
+    n_centroids = n_folds * n_classes
+    k = sizes[:, None, None].astype(np.float64)
+    sx = sums[:, :n_samples][:, :, None]
+    sxx = sums[:, n_samples:2 * n_samples][:, :, None]
+    pos = 2 * n_samples
+    sc = sums[:, pos:pos + n_centroids].reshape(-1, n_folds, n_classes)[:, folds]
+    scc = sums[:, pos + n_centroids:pos + 2 * n_centroids].reshape(-1, n_folds, n_classes)[:, folds]
+    sxc = sums[:, pos + 2 * n_centroids:].reshape(-1, n_samples, n_classes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (sxc - sx * sc / k) / np.sqrt((sxx - sx ** 2 / k) * (scc - sc ** 2 / k))
+    correct = np.where(np.isnan(r), -np.inf, r).argmax(axis=2) == y
+    counts = np.bincount(folds, minlength=n_folds).astype(float)
+    return np.array([correct[:, folds == fold].sum(axis=1) for fold in range(n_folds)]).T / counts
+
+
+def _accuracy_block(arrays, start, stop, block_size):
+    y, folds = np.asarray(arrays['y']), np.asarray(arrays['folds'])
+    n_classes = int(y.max()) + 1
+    results = np.zeros((len(arrays['sizes']), stop - start, folds.max() + 1))
+    for first in range(start, stop, block_size):
+        last = min(first + block_size, stop)
+        for i, sums in enumerate(nested_sums(arrays['values'], arrays, first, last)):
+            results[i, first - start:last - start] = fold_accuracy(sums, arrays['sizes'][i, first:last], y, folds,
+                                                                   n_classes)
+    return results
+
+
+def cv_searchlight(samples, index, targets, partition, block_size=BLOCK_SIZE, n_proc=1):
+    """
+    Cross-validated nearest-centroid searchlight over every centre of the index.
+    :param index: neighbour index, or list of neighbour indexes of increasing radii
+    :param targets: target of every sample (dataset.targets)
+    :param partition: the attribute whose values are left out in turn (dataset.chunks, dataset.sa.modality)
+    :param n_proc: number of worker processes (searchlight.parallel_blocks)
+    :return: folds x centres array of accuracies, as the CrossValidation searchlight (one per radius for a list)
+    """
+    indexes = as_indexes(index)
+    folds = test_folds(partition)
+    values, y = centroid_values(samples, targets, folds)
+    arrays = nested_shells(indexes)
+    arrays.update({'values': values, 'y': y, 'folds': folds})
+    return searchlight_maps(run_blocks(_accuracy_block, arrays, len(indexes[0][0]) - 1, n_proc, (block_size,)),
+                            index)
@@ -1,10 +1,12 @@
 from mvpa2.suite import *
 from subjects import *
+from searchlight import neighbour_index
+from classifier_kernel import cv_searchlight
+from sample_cache import cached_dataset
 import numpy as np
 import random
 import sys
-import pickle as pkl
-from xtask_move_classification_sl import mark_bad_trials
+from xtask_classification_sl import mark_bad_trials, load_good_trials, subject_attributes
 
 subject_list = sys.argv[1:] if len(sys.argv) > 1 else EVERYONE
 print(subject_list)
@@ -15,8 +17,9 @@ DATA_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/tstats/'
 MASK_DIR = '/u/project/cparkins/data/hierarchy/derivatives/masks/ribbon_masks/'
 OUTDIR = '/u/project/cparkins/data/hierarchy/derivatives/mvpa_volume/nav_classification_sl/native_trialwise_dil3thr0/'
 N_PROC = 6
+SEARCHLIGHT_ENGINE = 'pymvpa'  # 'numpy': cross-validated nearest-centroid searchlight (classifier_kernel.py)
 
-RADIUS = 4
+RADII = [4]  # increasing searchlight radii in voxels, one map per radius
 
 
 def main(subj, info):
@@ -24,11 +27,8 @@ def main(subj, info):
     subj_mask = MASK_DIR + '%s_ribbon_rsmp0_dil3mm.nii.gz' % subj
     # read in fmri runs and assign sample attributes
     subj_data = DATA_DIR + '%s_tstats/%s_%s.nii.gz' % (TASK, subj, TASK[:3]) #[:3]
-    raw_ds = fmri_dataset(samples=subj_data, mask=subj_mask)
-    if TASK[:3] == 'nav' and subj == 'sub-156':
-        attr = SampleAttributes(DATA_DIR + 'nav_trialwise_attr_bin_156.txt')
-    else:
-        attr = SampleAttributes(DATA_DIR + '%s_attr_bin.txt' % TASK)
+    raw_ds = cached_dataset(subj_data, subj_mask)
+    attr = subject_attributes(TASK[:3], subj)
     mark_bad_trials(subj, 'nav', 4, attr, info)
     raw_ds.sa['targets'] = attr.targets  # targets: run types (up/down)
     raw_ds.sa['chunks'] = attr.chunks    # chunks: run #s
@@ -47,16 +47,22 @@ def main(subj, info):
     zscore(dataset)
 
     # run
-    cv = CrossValidation(LinearCSVMC(), NFoldPartitioner(), errorfx=lambda p, t: np.mean(p == t))
-    sl = sphere_searchlight(cv, radius=RADIUS, postproc=mean_sample(), nproc=N_PROC)
-    result = sl(dataset)
+    if SEARCHLIGHT_ENGINE == 'numpy':
+        # NFoldPartitioner folds over chunks, averaged as mean_sample(), all radii in one pass
+        indexes = [neighbour_index(dataset.fa.voxel_indices, radius) for radius in RADII]
+        accuracies = cv_searchlight(dataset.samples, indexes, dataset.targets, dataset.chunks, n_proc=N_PROC)
+        results = [Dataset(accuracy.mean(axis=0)[None, :]) for accuracy in accuracies]
+    else:
+        cv = CrossValidation(LinearCSVMC(), NFoldPartitioner(), errorfx=lambda p, t: np.mean(p == t))
+        results = [sphere_searchlight(cv, radius=radius, postproc=mean_sample(), nproc=N_PROC)(dataset)
+                   for radius in RADII]
 
-    rfilename = OUTDIR + "{}_{}vox_{}_svm_sl.nii.gz".format(subj, RADIUS, TASK[:3])
-    map2nifti(dataset, result.samples.reshape((-1, dataset.nfeatures))).to_filename(rfilename)
+    for radius, result in zip(RADII, results):
+        rfilename = OUTDIR + "{}_{}vox_{}_svm_sl.nii.gz".format(subj, radius, TASK[:3])
+        map2nifti(dataset, result.samples.reshape((-1, dataset.nfeatures))).to_filename(rfilename)
 
 
 if __name__ == '__main__':
-    with open('../lv1/good_trials.pkl', 'rb') as infile:
-        info = pkl.load(infile)
+    info = load_good_trials('../lv1/good_trials.npz')
     for subj in subject_list:
         main(subj, info)
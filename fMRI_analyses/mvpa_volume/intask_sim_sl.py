@@ -9,6 +9,9 @@ import numpy as np
 try:
     from xtask_sim_sl import CustomDist
     from subjects import *
+    from searchlight import neighbour_index
+    from rsa_kernel import sim_searchlight, perm_searchlight
+    from sample_cache import cached_dataset
 except ImportError:
     pass
 
@@ -21,7 +24,10 @@ OUTFILE = '%s_nav_%dvox_sim.nii.gz'
 # OUTDIR = '/u/project/cparkins/data/hierarchy/derivatives/mvpa_volume/saccades_rsa_sl/native_sim_dil3mm0thr/'
 # OUTFILE = '%s_sac_%dvox_sim.nii.gz'
 
-SEARCHLIGHT_RADIUS = 4
+SEARCHLIGHT_RADII = [4]  # increasing radii in voxels, one map per radius
+SEARCHLIGHT_ENGINE = 'pymvpa'  # 'numpy': cached sphere index (searchlight.py) and batched CustomDist (rsa_kernel.py)
+N_PROC = 6  # worker processes of the numpy engine, sharing memory-mapped samples
+N_PERMUTATIONS = 0  # > 0 (numpy engine): also write a p-map of label permutations within runs
 
 LABELS_SAC = [  # for saccades
     # down7, left7, right7, up7, down8, left8, right8, up8
@@ -67,19 +73,31 @@ def main():
 
     for subj in subject_list:
         tstats_file = TSTATS_DIR + TSTATS_NAME + '_tstats/%s_%s.nii.gz' % (subj, TSTATS_NAME)
-        dataset = fmri_dataset(samples=tstats_file,
-                               mask=MASK_DIR + '%s_ribbon_rsmp0_dil3mm.nii.gz' % subj)
+        dataset = cached_dataset(tstats_file, MASK_DIR + '%s_ribbon_rsmp0_dil3mm.nii.gz' % subj)
         dataset.sa['chunks'] = attr.chunks
         dataset.sa['targets'] = attr.targets
         dataset = remove_invariant_features(dataset)
 
         similarity = CustomDist(squareform(LABELS_NAV))
-        searchlight = sphere_searchlight(similarity, SEARCHLIGHT_RADIUS)
-        searchlight_map = searchlight(dataset)
+        if SEARCHLIGHT_ENGINE == 'numpy':
+            # all radii in one pass, the spheres growing shell by shell
+            indexes = [neighbour_index(dataset.fa.voxel_indices, radius) for radius in SEARCHLIGHT_RADII]
+            if N_PERMUTATIONS:
+                maps = perm_searchlight(dataset.samples, indexes, similarity.labels, N_PERMUTATIONS,
+                                        dataset.sa.chunks, n_proc=N_PROC)
+            else:
+                maps = sim_searchlight(dataset.samples, indexes, similarity.labels, n_proc=N_PROC)
+        else:
+            maps = [sphere_searchlight(similarity, radius)(dataset) for radius in SEARCHLIGHT_RADII]
 
         # save files
-        nifti = map2nifti(data=searchlight_map, dataset=dataset)
-        nifti.to_filename(OUTDIR + OUTFILE % (subj, SEARCHLIGHT_RADIUS))
+        for radius, searchlight_map in zip(SEARCHLIGHT_RADII, maps):
+            if SEARCHLIGHT_ENGINE == 'numpy' and N_PERMUTATIONS:
+                p_file = OUTDIR + OUTFILE.replace('_sim', '_sim_p') % (subj, radius)
+                map2nifti(data=searchlight_map[1:], dataset=dataset).to_filename(p_file)
+                searchlight_map = searchlight_map[:1]
+            nifti = map2nifti(data=searchlight_map, dataset=dataset)
+            nifti.to_filename(OUTDIR + OUTFILE % (subj, radius))
 
 
 if __name__ == '__main__':
@@ -74,6 +74,8 @@ function smooth_permtest() {
               -C $clusterThreshold \
               -m $maskFile \
               -x -1 -T --uncorrp
+    # same test in python (tfce.py): writes <prefix>_tstat.nii.gz and <prefix>_tfce_p.nii.gz
+    # python tfce.py ${transformOutpath}/${smoothedFile}.nii.gz $maskFile ${transformOutpath}/oneSampT_${mniVoxSize}MNI_${kernel}mm-sm_${numPermutations}perm $numPermutations 8
     fdr -i ${transformOutpath}/oneSampT_${mniVoxSize}MNI_${kernel}mm-sm_${varSmoothKernal}mm-var-sm_${numPermutations}perm_${clusterThreshold}thr_vox_p_tstat1.nii.gz \
         --oneminusp -m $maskFile -q 0.05 \
         --othresh=${transformOutpath}/oneSampT_${mniVoxSize}MNI_${kernel}mm-sm_${varSmoothKernal}mm-var-sm_${numPermutations}perm_vox_p_tstat1_0.05fdr.nii.gz
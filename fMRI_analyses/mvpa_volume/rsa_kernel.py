@@ -0,0 +1,190 @@
+"""
+Batched version of the CustomDist searchlight measure (xtask_sim_sl.py).
+
+CustomDist correlates the samples of every sphere (pdist 'correlation'), Fisher-z transforms
+the labelled pairs, z-scores them and returns mean(label 1 pairs) - mean(label 2 pairs).
+Here the sample matrix is centred and scaled once, and for each labelled pair (a, b) the
+sums over a sphere's features of x_a, x_a ** 2 and x_a * x_b are obtained for all spheres at
+once, as sparse sphere x feature products (searchlight.sphere_matrix).  The correlations of
+a sphere follow from those sums, and since z-scoring only shifts and scales,
+    delta sim = (mean(z[label 1]) - mean(z[label 2])) / std(z)
+is one matrix product with a precomputed weight vector.
+
+The permutation mode (perm_searchlight) relies on the correlations of a sphere not depending
+on the labels: the Fisher z of all sample pairs are computed once per sphere, and the label
+vectors of every permutation of the samples (within exchangeability blocks such as runs) are
+columns of one weight matrix.  The mean and std of the compared pairs of each permutation are
+matrix products as well, so the observed and null CustomDist values of a block of spheres come
+from three products, and the p-map is the fraction of permutations reaching the observed value.
+When the blocks allow no more permutations than requested (e.g. two samples per run), all the
+distinct label patterns they produce are used instead, as an exact test.
+
+Given a list of sphere indexes of increasing radii, the searchlights return one map per radius,
+growing the sphere sums shell by shell (searchlight.nested_sums).
+"""
+
+from itertools import permutations, product
+from math import factorial
+import numpy as np
+from scipy.spatial.distance import squareform
+from searchlight import as_indexes, nested_shells, nested_sums, run_blocks, searchlight_maps, BLOCK_SIZE
+
+N_PERMUTATIONS = 1000
+
+
+def label_pairs(labels, n_samples):
+    """
+    :param labels: condensed (pdist order) label vector, 0: not compared, 1: matching, 2: mismatching
+    :param n_samples: number of samples
+    :return: sample indices a, b and label of every compared pair
+    """
+    labels = np.asarray(labels)
+    a, b = np.triu_indices(n_samples, 1)
+    assert len(labels) == len(a), 'labels do not match %d samples' % n_samples
+    compared = labels != 0
+    return a[compared], b[compared], labels[compared]
+
+
+def sim_weights(cond):
+    # mean of label 1 pairs minus mean of label 2 pairs, as a weight vector (columns: label vectors)
+    cond = np.asarray(cond)
+    return (cond == 1) / (cond == 1).sum(axis=0, dtype=float) - (cond == 2) / (cond == 2).sum(axis=0, dtype=float)
+
+
+def pair_values(samples, a, b):
+    # features x columns of x_a, x_a ** 2 and x_a * x_b for all samples and pairs
+    x = np.asarray(samples, dtype=np.float64)
+    x = (x - x.mean(axis=1, keepdims=True)) / x.std(axis=1, keepdims=True)  # correlations are unchanged
+    return np.hstack([x.T, (x ** 2).T, (x[a] * x[b]).T])
+
+
+def fisher_z(sums, sizes, a, b, n_samples):
+    """
+    Fisher-z correlations of the compared pairs, from the sphere sums of pair_values.
+    :return: spheres x pairs array
+    """
+    k = sizes[:, None].astype(np.float64)
+    s = sums[:, :n_samples]
+    var = sums[:, n_samples:2 * n_samples] - s ** 2 / k
+    cov = sums[:, 2 * n_samples:] - s[:, a] * s[:, b] / k
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.arctanh(cov / np.sqrt(var[:, a] * var[:, b]))
+
+
+def sphere_fisher_z(values, shells, a, b, n_samples, start, stop, block_size=BLOCK_SIZE):
+    """
+    Fisher-z correlations of the compared pairs of the spheres of centres start to stop, block by block.
+    :param values: pair_values of the samples
+    :param shells: searchlight.nested_shells of the sphere indexes
+    :param a, b: sample indices of the pairs (label_pairs)
+    :return: generator of (first centre, radius number, spheres x pairs array)
+    """
+    for first in range(start, stop, block_size):
+        last = min(first + block_size, stop)
+        for i, sums in enumerate(nested_sums(values, shells, first, last)):
+            yield first, i, fisher_z(sums, shells['sizes'][i, first:last], a, b, n_samples)
+
+
+def delta_sim(z, weights):
+    # CustomDist value of every sphere, for one label assignment (weight vector) or many (pairs x assignments)
+    std = z.std(axis=1)
+    return z.dot(weights) / (std[:, None] if np.ndim(weights) > 1 else std)
+
+
+def _sim_block(arrays, start, stop, a, b, weights, block_size):
+    results = np.zeros((len(arrays['sizes']), stop - start, 1))
+    for first, i, z in sphere_fisher_z(arrays['values'], arrays, a, b, int(arrays['n_samples'][0]),
+                                       start, stop, block_size):
+        results[i, first - start:first - start + len(z), 0] = delta_sim(z, weights)
+    return results
+
+
+def sim_searchlight(samples, index, labels, block_size=BLOCK_SIZE, n_proc=1):
+    """
+    CustomDist searchlight over every centre of the index.
+    :param index: neighbour index, or list of neighbour indexes of increasing radii
+    :param n_proc: number of worker processes (searchlight.parallel_blocks)
+    :return: 1 x centres array, as run_searchlight (a list of them, one per radius, for a list of indexes)
+    """
+    indexes = as_indexes(index)
+    a, b, cond = label_pairs(labels, len(samples))
+    arrays = nested_shells(indexes)
+    arrays.update({'values': pair_values(samples, a, b), 'n_samples': np.array([len(samples)])})
+    args = (a, b, sim_weights(cond), block_size)
+    return searchlight_maps(run_blocks(_sim_block, arrays, len(indexes[0][0]) - 1, n_proc, args), index)
+
+
+def permuted_labels(labels, n_samples, n_perm, groups=None, seed=0):
+    """
+    :param labels: condensed (pdist order) label vector, as CustomDist
+    :param groups: exchangeability block of every sample; samples are only permuted within a block (default: all)
+    :return: pairs x (1 + permutations) labels of all sample pairs, the first column being the observed labels.
+             If the blocks allow at most n_perm permutations, all distinct label patterns are enumerated instead
+             of drawing n_perm random permutations.
+    """
+    square = squareform(np.asarray(labels))
+    assert len(square) == n_samples, 'labels do not match %d samples' % n_samples
+    groups = np.zeros(n_samples) if groups is None else np.asarray(groups)
+    members = [np.flatnonzero(groups == group) for group in np.unique(groups)]
+    a, b = np.triu_indices(n_samples, 1)
+    observed = square[a, b]
+    n_orders = np.prod([float(factorial(len(m))) for m in members])
+    if n_orders <= n_perm:
+        orders = []
+        for shuffles in product(*[permutations(m) for m in members]):
+            order = np.arange(n_samples)
+            for m, shuffled in zip(members, shuffles):
+                order[m] = shuffled
+            orders.append(order)
+        patterns = np.unique(np.array([square[order[a], order[b]] for order in orders]), axis=0)
+        null = [pattern for pattern in patterns if not np.array_equal(pattern, observed)]
+        print('All %d distinct label permutations used (%d requested), smallest p = %.4g'
+              % (len(null) + 1, n_perm, 1. / (len(null) + 1)))
+        return np.column_stack([observed] + null)
+    rng = np.random.RandomState(seed)
+    cond = [observed]
+    for _ in range(n_perm):
+        order = np.arange(n_samples)
+        for m in members:
+            order[m] = rng.permutation(m)
+        cond.append(square[order[a], order[b]])
+    return np.column_stack(cond)
+
+
+def perm_sim(z, cond):
+    # CustomDist values of every sphere (rows of z, all pairs) for every label column of cond
+    compared = (cond != 0) / (cond != 0).sum(axis=0, dtype=float)
+    mean = z.dot(compared)
+    std = np.sqrt(np.maximum((z ** 2).dot(compared) - mean ** 2, 0))
+    return z.dot(sim_weights(cond)) / std
+
+
+def _perm_block(arrays, start, stop, a, b, block_size):
+    results = np.zeros((len(arrays['sizes']), stop - start, 2))
+    for first, i, z in sphere_fisher_z(arrays['values'], arrays, a, b, int(arrays['n_samples'][0]),
+                                       start, stop, block_size):
+        sim = perm_sim(z, arrays['cond'])
+        with np.errstate(invalid='ignore'):
+            exceed = (sim[:, 1:] >= sim[:, :1]).sum(axis=1)
+        p = (1. + exceed) / sim.shape[1]
+        p[np.isnan(sim[:, 0])] = np.nan
+        results[i, first - start:first - start + len(z)] = np.column_stack([sim[:, 0], p])
+    return results
+
+
+def perm_searchlight(samples, index, labels, n_perm=N_PERMUTATIONS, groups=None, block_size=BLOCK_SIZE, n_proc=1):
+    """
+    CustomDist searchlight with a label-permutation p-value at every centre.
+    :param index: neighbour index, or list of neighbour indexes of increasing radii
+    :param n_perm: number of permutations of the samples
+    :param groups: exchangeability block of every sample (e.g. dataset.sa.chunks)
+    :return: 2 x centres array, the observed CustomDist value and the one-sided p-value (one per radius for a list)
+    """
+    indexes = as_indexes(index)
+    n_samples = len(samples)
+    a, b = np.triu_indices(n_samples, 1)
+    arrays = nested_shells(indexes)
+    arrays.update({'values': pair_values(samples, a, b), 'n_samples': np.array([n_samples]),
+                   'cond': permuted_labels(labels, n_samples, n_perm, groups)})
+    args = (a, b, block_size)
+    return searchlight_maps(run_blocks(_perm_block, arrays, len(indexes[0][0]) - 1, n_proc, args), index)
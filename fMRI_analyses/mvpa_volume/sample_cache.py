@@ -0,0 +1,76 @@
+"""
+Cache of masked sample matrices, shared by the volume MVPA scripts.
+
+fmri_dataset(samples=<tstats .nii.gz>, mask=<ribbon mask>) decompresses the tstats and applies
+the mask on every call.  Here the masked samples are stored once in CACHE_DIR as a float32
+samples x voxels .npy, with the voxels x 3 voxel indices, under a hash of the contents of the
+data and mask files; later loads memory-map the .npy.
+
+cached_dataset() is a drop-in for fmri_dataset(samples=..., mask=...): the mapper and feature
+attributes come from the (small) mask image, so map2nifti works on the result as before.  The
+samples are mapped copy-on-write, so in-place operations such as zscore() do not touch the cache.
+"""
+
+import hashlib
+import os
+import numpy as np
+import nibabel as nib
+from searchlight import make_dir
+
+CACHE_DIR = '/u/project/cparkins/data/hierarchy/derivatives/mvpa_volume/sample_cache/'
+HASH_CHUNK = 1 << 20
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(HASH_CHUNK), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cache_files(data_file, mask_file, cache_dir):
+    key = hashlib.sha1((file_hash(data_file) + file_hash(mask_file)).encode()).hexdigest()[:20]
+    name = os.path.basename(data_file).split('.')[0]
+    return (os.path.join(cache_dir, '%s_%s_samples.npy' % (name, key)),
+            os.path.join(cache_dir, '%s_%s_coords.npy' % (name, key)))
+
+
+def write_cache(data_file, mask_file, samples_file, coords_file):
+    # mask and store the volumes one at a time, then move the files in place
+    mask = np.asarray(nib.load(mask_file).dataobj) != 0
+    coords = np.array(np.nonzero(mask)).T
+    data = nib.load(data_file, keep_file_open=True).dataobj  # one gzip stream for all volumes
+    n_samples = data.shape[3] if len(data.shape) > 3 else 1
+    tmp_suffix = '.%d.tmp.npy' % os.getpid()
+    samples = np.lib.format.open_memmap(samples_file + tmp_suffix, mode='w+', dtype=np.float32,
+                                        shape=(n_samples, len(coords)))
+    for i in range(n_samples):
+        samples[i] = np.asarray(data[..., i] if len(data.shape) > 3 else data)[mask]
+    samples.flush()
+    del samples
+    np.save(coords_file + tmp_suffix, coords.astype(np.int32))
+    os.rename(coords_file + tmp_suffix, coords_file)
+    os.rename(samples_file + tmp_suffix, samples_file)
+
+
+def masked_samples(data_file, mask_file, cache_dir=CACHE_DIR, mmap_mode='r'):
+    """
+    :param data_file: 3D or 4D NIfTI file of the samples
+    :param mask_file: NIfTI mask, non-zero voxels are kept
+    :return: samples x voxels float32 array (memory-mapped) and voxels x 3 voxel indices
+    """
+    samples_file, coords_file = cache_files(data_file, mask_file, cache_dir)
+    if not os.path.exists(samples_file):
+        make_dir(cache_dir)
+        write_cache(data_file, mask_file, samples_file, coords_file)
+    return np.load(samples_file, mmap_mode=mmap_mode), np.load(coords_file)
+
+
+def cached_dataset(samples, mask, cache_dir=CACHE_DIR):
+    # fmri_dataset(samples=samples, mask=mask) with the samples from the cache
+    from mvpa2.suite import Dataset, fmri_dataset
+    data, coords = masked_samples(samples, mask, cache_dir, mmap_mode='c')
+    template = fmri_dataset(samples=mask, mask=mask)
+    assert np.array_equal(template.fa.voxel_indices, coords), 'cached voxels do not match %s' % mask
+    return Dataset(data, fa=template.fa.copy(deep=True), a=template.a.copy(deep=True))
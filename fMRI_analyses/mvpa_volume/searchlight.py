@@ -0,0 +1,245 @@
+"""
+Searchlight engine in NumPy, an alternative to PyMVPA's sphere_searchlight.
+
+The sphere neighbours of every voxel in the dataset are computed once per (voxel set, radius)
+as a CSR index: the neighbours of centre i are indices[indptr[i]:indptr[i + 1]], as feature
+indices.  The index is cached in INDEX_DIR under a hash of the voxel coordinates and the
+radius, so all searchlights over the same mask reuse it.
+
+Measures are evaluated on BLOCK_SIZE centres at a time: the samples of all spheres of a block
+are gathered into one (centres x samples x max sphere size) array, zero-padded, with a
+(centres x max sphere size) boolean array marking the real features.  A measure takes
+(data, valid) and returns one value (or one row of values) per centre.  per_sphere() turns a
+function of a single sphere's samples x features array into such a measure.  Measures that
+only need sums over the sphere's features can use sphere_matrix() instead (see rsa_kernel.py).
+
+Sum-based measures can also run several radii in one pass: the spheres of increasing radii
+around a centre are nested, so nested_shells() stores the smallest spheres and the shells
+that grow each sphere to the next radius, and nested_sums() adds the sums over the shells to
+the sums of the previous radius instead of summing every sphere from scratch.
+
+With n_proc > 1, the centres are split into contiguous blocks over a pool of worker processes
+(parallel_blocks).  The samples and the sphere index are written once as .npy files in
+SHARED_DIR and memory-mapped by every worker, so workers share one copy of the data instead
+of each receiving a pickled dataset.
+
+Usage in the searchlight scripts (dataset from fmri_dataset):
+    index = neighbour_index(dataset.fa.voxel_indices, radius)
+    result = run_searchlight(dataset.samples, index, measure)   # outputs x features, as sphere_searchlight
+"""
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+from itertools import product
+import numpy as np
+from scipy.sparse import csr_matrix
+
+INDEX_DIR = '/u/project/cparkins/data/hierarchy/derivatives/mvpa_volume/sphere_index/'
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None  # memory-backed files shared by the workers
+BLOCK_SIZE = 1000  # number of centres gathered at a time
+BLOCKS_PER_PROC = 4  # contiguous blocks of centres per worker process, to even out the load
+_shared = {}  # arrays memory-mapped by a worker process
+
+
+def sphere_offsets(radius):
+    # voxel offsets within radius (in voxels) of the centre, as in PyMVPA's Sphere
+    r = int(np.floor(radius))
+    offsets = np.array(list(product(range(-r, r + 1), repeat=3)))
+    return offsets[np.sqrt((offsets ** 2).sum(axis=1)) <= radius]
+
+
+def index_file(coords, radius, cache_dir):
+    digest = hashlib.sha1(np.ascontiguousarray(coords, dtype=np.int32).tobytes()).hexdigest()
+    return os.path.join(cache_dir, '%s_r%g.npz' % (digest[:20], radius))
+
+
+def build_index(coords, radius):
+    """
+    :param coords: features x 3 voxel indices of the dataset
+    :param radius: sphere radius in voxels
+    :return: indptr (features + 1) and indices (sum of sphere sizes) int32 arrays
+    """
+    coords = np.asarray(coords, dtype=int)
+    r = int(np.floor(radius))
+    grid = coords - coords.min(axis=0) + r  # padded so that no offset leaves the lookup volume
+    lookup = -np.ones(grid.max(axis=0) + r + 1, dtype=np.int32)
+    lookup[tuple(grid.T)] = np.arange(len(coords))
+    centres = []
+    neighbours = []
+    for offset in sphere_offsets(radius):
+        found = lookup[tuple((grid + offset).T)]
+        inside = found >= 0
+        centres.append(np.flatnonzero(inside))
+        neighbours.append(found[inside])
+    centres = np.concatenate(centres)
+    neighbours = np.concatenate(neighbours)
+    order = np.lexsort((neighbours, centres))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(centres, minlength=len(coords)))]).astype(np.int32)
+    return indptr, neighbours[order].astype(np.int32)
+
+
+def make_dir(path):
+    # makedirs that tolerates another job creating the directory at the same time
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def neighbour_index(coords, radius, cache_dir=INDEX_DIR):
+    # sphere neighbour index of the voxels, from the cache if it was built before
+    cache_file = index_file(coords, radius, cache_dir)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as index:
+            return index['indptr'], index['indices']
+    indptr, indices = build_index(coords, radius)
+    make_dir(cache_dir)
+    tmp_file = cache_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'wb') as outfile:
+        np.savez(outfile, indptr=indptr, indices=indices)
+    os.rename(tmp_file, cache_file)
+    return indptr, indices
+
+
+def sphere_matrix(index, start=0, stop=None):
+    # centres x features sparse 0/1 matrix of the spheres, so that sphere sums of feature values are one product
+    indptr, indices = index
+    n_features = len(indptr) - 1
+    ptr = np.asarray(indptr[start:(n_features if stop is None else stop) + 1])
+    return csr_matrix((np.ones(ptr[-1] - ptr[0]), indices[ptr[0]:ptr[-1]], ptr - ptr[0]),
+                      shape=(len(ptr) - 1, n_features))
+
+
+def as_indexes(index):
+    # list of sphere indexes, from a single neighbour index or a list of them (increasing radii)
+    return list(index) if isinstance(index, list) else [index]
+
+
+def nested_shells(indexes):
+    """
+    :param indexes: neighbour indexes of increasing radii over the same voxels
+    :return: dictionary of the CSR arrays of the smallest spheres (indptr0, indices0), of the shells
+             adding the features of each next radius (indptr1, indices1, ...) and of the sphere sizes
+             (sizes, radii x centres), as arrays for parallel_blocks
+    """
+    shells = {'indptr0': indexes[0][0], 'indices0': indexes[0][1],
+              'sizes': np.array([np.diff(indptr) for indptr, _ in indexes])}
+    for i in range(1, len(indexes)):
+        shell = sphere_matrix(indexes[i]) - sphere_matrix(indexes[i - 1])
+        shell.eliminate_zeros()
+        assert (shell.data == 1).all(), 'spheres of radius %d are not within the next radius' % i
+        shells['indptr%d' % i] = shell.indptr.astype(np.int32)
+        shells['indices%d' % i] = shell.indices.astype(np.int32)
+    return shells
+
+
+def nested_sums(values, shells, start, stop):
+    # sums of values over the spheres of centres start to stop, radius by radius
+    sums = 0
+    for i in range(len(shells['sizes'])):
+        sums = sums + sphere_matrix((shells['indptr%d' % i], shells['indices%d' % i]), start, stop).dot(values)
+        yield sums
+
+
+def gather(samples, index, centres):
+    """
+    :param samples: samples x features array
+    :param index: (indptr, indices) from neighbour_index
+    :param centres: feature indices of the sphere centres
+    :return: centres x samples x max sphere size array (zero-padded) and centres x max sphere size valid mask
+    """
+    indptr, indices = index
+    starts = indptr[centres]
+    sizes = indptr[centres + 1] - starts
+    valid = np.arange(sizes.max())[None, :] < sizes[:, None]
+    features = np.where(valid, indices[np.minimum(starts[:, None] + np.arange(valid.shape[1]), len(indices) - 1)], 0)
+    data = samples[:, features].transpose(1, 0, 2)
+    data *= valid[:, None, :]
+    return data, valid
+
+
+class per_sphere(object):
+    # a block measure calling func(samples x features array of one sphere) for every centre (picklable with func)
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, data, valid):
+        return np.array([self.func(sphere[:, mask]) for sphere, mask in zip(data, valid)])
+
+
+def _attach(shared_dir, names):
+    for name in names:
+        _shared[name] = np.load(os.path.join(shared_dir, name + '.npy'), mmap_mode='r')
+
+
+def _run_block(job):
+    func, start, stop, args = job
+    return func(_shared, start, stop, *args)
+
+
+def parallel_blocks(func, arrays, n_items, n_proc, args=()):
+    """
+    Run func(arrays, start, stop, *args) over contiguous blocks of range(n_items) in a pool of n_proc processes.
+    :param func: module-level function (it is sent to the workers by name)
+    :param arrays: dictionary of arrays, shared with the workers as memory-mapped .npy files
+    :return: list of the results of func, in block order
+    """
+    bounds = np.linspace(0, n_items, min(n_items, n_proc * BLOCKS_PER_PROC) + 1).astype(int)
+    jobs = [(func, start, stop, args) for start, stop in zip(bounds[:-1], bounds[1:])]
+    shared_dir = tempfile.mkdtemp(prefix='searchlight_', dir=SHARED_DIR)
+    try:
+        for name, values in arrays.items():
+            np.save(os.path.join(shared_dir, name + '.npy'), np.asarray(values))
+        pool = multiprocessing.Pool(n_proc, _attach, (shared_dir, list(arrays)))
+        try:
+            return pool.map(_run_block, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(shared_dir)
+
+
+def run_blocks(func, arrays, n_centres, n_proc, args=()):
+    # func(arrays, start, stop, *args) -> radii x centres x outputs array, over all centres
+    if n_proc > 1:
+        return np.concatenate(parallel_blocks(func, arrays, n_centres, n_proc, args), axis=1)
+    return func(arrays, 0, n_centres, *args)
+
+
+def searchlight_maps(results, index):
+    # outputs x centres map of every radius of run_blocks, or the only map if index is a single neighbour index
+    maps = [result.T for result in results]
+    return maps if isinstance(index, list) else maps[0]
+
+
+def _measure_block(arrays, start, stop, measure, block_size):
+    # outputs of a block measure over centres[start:stop], block_size centres at a time
+    index = (arrays['indptr'], arrays['indices'])
+    centres = np.asarray(arrays['centres'][start:stop])
+    results = [np.asarray(measure(*gather(arrays['samples'], index, centres[i:i + block_size])))
+               for i in range(0, len(centres), block_size)]
+    return np.concatenate(results).reshape(len(centres), -1)
+
+
+def run_searchlight(samples, index, measure, centres=None, block_size=BLOCK_SIZE, n_proc=1):
+    """
+    :param samples: samples x features array
+    :param index: (indptr, indices) from neighbour_index
+    :param measure: function of (data, valid) of a block of spheres, see gather (picklable if n_proc > 1)
+    :param centres: feature indices of the centres (default all features)
+    :param n_proc: number of worker processes
+    :return: outputs x centres array
+    """
+    if centres is None:
+        centres = np.arange(len(index[0]) - 1)
+    arrays = {'samples': np.asarray(samples), 'indptr': index[0], 'indices': index[1], 'centres': centres}
+    if n_proc > 1:
+        results = np.concatenate(parallel_blocks(_measure_block, arrays, len(centres), n_proc, (measure, block_size)))
+    else:
+        results = _measure_block(arrays, 0, len(centres), measure, block_size)
+    return results.T
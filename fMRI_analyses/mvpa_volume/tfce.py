@@ -0,0 +1,132 @@
+"""
+Group-level one-sample t-test of searchlight maps with TFCE and sign-flip permutations,
+in place of FSL "randomise -1 -T" (mni_permtest_*.sh).
+
+The 4D file of merged subject maps (MNI space, already smoothed / chance subtracted) is read
+once into a subjects x voxels matrix of the mask voxels.  Sign flips of the subjects leave
+the sum of squares of every voxel unchanged, so the t-map of a permutation is one product of
+the sign vector with the matrix.  TFCE follows randomise's defaults (H = 2, E = 0.5, 6-connected
+clusters, height step = max t / 100): at every height, the clusters of the supra-threshold
+voxels are labelled in one pass and each voxel gets its cluster's size.
+
+The permutations are split over a pool of processes (searchlight.parallel_blocks), which
+memory-map the matrix and the mask; each returns the maximum TFCE of its permutations.
+Permutation 0 is the unflipped data, and all 2 ** subjects sign patterns are used when there
+are no more than the requested number of permutations.
+
+Outputs (as randomise's tstat1 and tfce_corrp_tstat1, the maps in fMRI_results):
+    <prefix>_tstat.nii.gz    t-statistic
+    <prefix>_tfce_p.nii.gz   1 - FWE-corrected p-value of the positive TFCE
+
+Usage: python tfce.py <merged maps> <mask> <output prefix> [n permutations] [n processes]
+"""
+
+import sys
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from searchlight import parallel_blocks
+
+N_PERMUTATIONS = 10000
+N_PROC = 1
+TFCE_H = 2.
+TFCE_E = .5
+TFCE_STEPS = 100  # height steps up to the maximum of each map
+CONNECTIVITY = ndimage.generate_binary_structure(3, 1)  # faces only, as randomise
+SEED = 0
+
+
+def tstat(samples, signs, sum_squares):
+    # one-sample t of every voxel after flipping the signs of the subjects' maps
+    n = len(samples)
+    mean = signs.dot(samples) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return mean / np.sqrt((sum_squares - n * mean ** 2) / (n - 1) / n)
+
+
+def tfce(stat_map, h=TFCE_H, e=TFCE_E, steps=TFCE_STEPS):
+    """
+    :param stat_map: 3D statistic map (only the positive part is enhanced)
+    :return: 3D TFCE map
+    """
+    enhanced = np.zeros(stat_map.shape)
+    top = np.nanmax(stat_map)
+    if not top > 0:
+        return enhanced
+    dh = top / steps
+    for height in np.arange(1, steps + 1) * dh:
+        clusters, n_clusters = ndimage.label(stat_map >= height, CONNECTIVITY)
+        if n_clusters == 0:
+            break
+        extent = np.bincount(clusters.ravel()).astype(float) ** e
+        extent[0] = 0
+        enhanced += extent[clusters] * (height ** h * dh)
+    return enhanced
+
+
+def sign_flips(perm, n_subjects, n_perm, seed=SEED):
+    if perm == 0:
+        return np.ones(n_subjects)
+    if 2 ** n_subjects <= n_perm:
+        return 1 - 2. * ((perm >> np.arange(n_subjects)) & 1)
+    return np.random.RandomState(seed + perm).choice([-1., 1.], n_subjects)
+
+
+def _perm_block(arrays, start, stop, n_perm):
+    # maximum TFCE of permutations start to stop
+    samples = arrays['samples']
+    mask = arrays['mask']
+    volume = np.zeros(mask.shape)
+    maxima = []
+    for perm in range(start, stop):
+        volume[mask] = tstat(samples, sign_flips(perm, len(samples), n_perm), arrays['sum_squares'])
+        maxima.append(tfce(np.nan_to_num(volume)).max())
+    return np.array(maxima)
+
+
+def randomise(samples, mask, n_perm=N_PERMUTATIONS, n_proc=N_PROC):
+    """
+    :param samples: subjects x mask voxels array
+    :param mask: 3D boolean mask (bounding box of the voxels is enough)
+    :return: t-map, TFCE map and FWE-corrected p-map of the mask voxels
+    """
+    n_perm = min(n_perm, 2 ** len(samples))
+    arrays = {'samples': np.asarray(samples, dtype=np.float64), 'mask': np.asarray(mask, dtype=bool),
+              'sum_squares': (np.asarray(samples, dtype=np.float64) ** 2).sum(axis=0)}
+    t_map = tstat(arrays['samples'], np.ones(len(samples)), arrays['sum_squares'])
+    volume = np.zeros(mask.shape)
+    volume[arrays['mask']] = np.nan_to_num(t_map)
+    tfce_map = tfce(volume)[arrays['mask']]
+    if n_proc > 1:
+        maxima = np.concatenate(parallel_blocks(_perm_block, arrays, n_perm, n_proc, (n_perm,)))
+    else:
+        maxima = _perm_block(arrays, 0, n_perm, n_perm)
+    # fraction of the permutation maxima reaching each voxel's TFCE, from the sorted maxima
+    maxima = np.sort(maxima)
+    exceed = len(maxima) - np.searchsorted(maxima, tfce_map - 1e-10 * maxima[-1], side='left')
+    p_map = exceed / float(len(maxima))
+    return t_map, tfce_map, p_map
+
+
+def main(maps_file, mask_file, prefix, n_perm=N_PERMUTATIONS, n_proc=N_PROC):
+    mask_img = nib.load(mask_file)
+    mask = mask_img.get_fdata() > 0
+    # bounding box of the mask, to label smaller volumes
+    box = tuple(slice(ax.min(), ax.max() + 1) for ax in np.nonzero(mask))
+    maps = nib.load(maps_file, keep_file_open=True).dataobj  # memory-mapped if not compressed, else one gzip stream
+    samples = np.array([np.asarray(maps[..., i])[box][mask[box]] for i in range(maps.shape[3])])
+    print('%d subjects, %d voxels, %d permutations, %d process(es)' % (len(samples), mask.sum(), n_perm, n_proc))
+    t_map, _, p_map = randomise(samples, mask[box], n_perm, n_proc)
+    header = mask_img.header.copy()
+    header.set_data_dtype(np.float32)
+    for name, values in (('tstat', t_map), ('tfce_p', 1 - p_map)):
+        volume = np.zeros(mask.shape, dtype=np.float32)
+        volume[mask] = np.nan_to_num(values)
+        nib.Nifti1Image(volume, mask_img.affine, header).to_filename('%s_%s.nii.gz' % (prefix, name))
+    print('%d voxels with corrected p < .05' % np.count_nonzero(p_map < .05))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], sys.argv[3],
+         int(sys.argv[4]) if len(sys.argv) > 4 else N_PERMUTATIONS,
+         int(sys.argv[5]) if len(sys.argv) > 5 else N_PROC)
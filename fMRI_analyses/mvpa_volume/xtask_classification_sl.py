@@ -1,8 +1,11 @@
 from mvpa2.suite import *
 import numpy as np
 from subjects import *
+from searchlight import neighbour_index
+from classifier_kernel import cv_searchlight
+from sample_cache import cached_dataset
+import os
 import sys
-import pickle as pkl
 
 # subjects
 subject_list = sys.argv[1:] if len(sys.argv) > 1 else EVERYONE
@@ -13,8 +16,8 @@ POWERFUL_DIRCT = 'eye_up'  # 'eye_right'  #
 POWERLESS_DIRCT = 'eye_down'  # 'eye_left'  #
 DIRCT = 'v'
 
-# specify searchlight sphere radius (in voxels)
-RADIUS = 4
+# specify searchlight sphere radii (in voxels)
+RADII = [4]  # increasing radii, one pair of maps per radius
 
 # specify directories containing t-stats and grey matter masks
 DATA_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/tstats/'
@@ -23,43 +26,56 @@ OUTDIR = '/u/project/cparkins/data/hierarchy/derivatives/mvpa_volume/xtask_class
 
 # num processors
 N_PROC = 6
+# 'numpy': cross-validated nearest-centroid searchlight (classifier_kernel.py) instead of LinearCSVMC
+SEARCHLIGHT_ENGINE = 'pymvpa'
 
-# attributes files
-nav_attr = SampleAttributes(DATA_DIR + 'nav_trialwise_attr_bin.txt')
-sac_attr = SampleAttributes(DATA_DIR + 'sac_trialwise_attr_bin.txt')
+
+def subject_attributes(name, subj):
+    # trialwise attributes (level1/trialwise_lss.py): the subject's own attr file if it has one, else the shared one
+    subject_file = DATA_DIR + '%s_trialwise_attr_bin_%s.txt' % (name, subj[4:])
+    if os.path.exists(subject_file):
+        return SampleAttributes(subject_file)
+    return SampleAttributes(DATA_DIR + '%s_trialwise_attr_bin.txt' % name)
+
+
+def load_good_trials(filename):
+    # good trials table from level1/trialwise_good_trials.py, with its {'subject/task': (start, stop)} row index
+    with np.load(filename) as npz:
+        table = dict(npz)
+    table['index'] = dict(zip(table['index_keys'], map(tuple, table['index_bounds'])))
+    return table
 
 
 def mark_bad_trials(subj, task, max_nonsteady, attr, info):
-    subj_task_info = info[task][subj]
+    start, stop = info['index']['%s/%s' % (subj, task)]
     # check if numbers match
-    n_trials = sum(map(len, subj_task_info.values()))
-    assert n_trials == len(attr.chunks)
-    assert n_trials == len(attr.targets)
-    n_run = len(subj_task_info)
-    flat_info = [item for run in range(1, n_run + 1) for item in subj_task_info[run]]
+    assert stop - start == len(attr.chunks)
+    assert stop - start == len(attr.targets)
+    # a first trial with non-steady volumes is judged by their number, the other trials by correctness
+    nonsteady = info['nonsteady_count'][start:stop]
+    bad = (nonsteady > max_nonsteady) | ((nonsteady == 0) & ~info['correct'][start:stop])
     # replace
-    for i, val in enumerate(flat_info):
-        if (np.issubdtype(type(val), np.integer) and val > max_nonsteady) or not val:
-            attr.chunks[i] = -1
-            attr.targets[i] = -1
+    for i in np.flatnonzero(bad):
+        attr.chunks[i] = -1
+        attr.targets[i] = -1
 
 
 def main(subj, info):
     print('Running ' + subj)
-    if subj == 'sub-156':
-        global nav_attr
-        nav_attr = SampleAttributes(DATA_DIR + 'nav_trialwise_attr_bin_156.txt')
+    # attributes files
+    nav_attr = subject_attributes('nav', subj)
+    sac_attr = subject_attributes('sac', subj)
     # read in mask file
     subj_mask = MASK_DIR + '%s_ribbon_rsmp0_dil3mm.nii.gz' % subj
     # read in navigation runs and assign sample attributes
     subj_nav_data = DATA_DIR + 'nav_trialwise_tstats/%s_nav.nii.gz' % subj
-    nav_ds = fmri_dataset(samples=subj_nav_data, mask=subj_mask)
+    nav_ds = cached_dataset(subj_nav_data, subj_mask)
     mark_bad_trials(subj, 'nav', 2, nav_attr, info)
     nav_ds.sa['chunks'] = nav_attr.chunks    # chunks: run #s
     nav_ds.sa['targets'] = nav_attr.targets  # targets: run types (up/down)
     # read in saccades runs and assign sample attributes
     subj_sac_data = DATA_DIR + 'sac_trialwise_tstats/%s_sac_trialwise.nii.gz' % subj
-    sac_ds = fmri_dataset(samples=subj_sac_data, mask=subj_mask)
+    sac_ds = cached_dataset(subj_sac_data, subj_mask)
     mark_bad_trials(subj, 'sacc', 4, sac_attr, info)
     sac_ds.sa['chunks'] = sac_attr.chunks
     sac_ds.sa['targets'] = sac_attr.targets
@@ -86,27 +102,33 @@ def main(subj, info):
     # zscore voxel values across examples within each task (so separate for training and testing data)
     zscore(dataset, chunks_attr='modality')
 
-    # create partitions for training and testing
-    partitioner = HalfPartitioner(attr='modality')
-    # cross-validation
-    clf = LinearCSVMC()  # get_feature_selection_clf()  #
-    cv = CrossValidation(clf, partitioner, errorfx=lambda p, t: np.mean(p == t))
-    # initialize searchlight
-    # collapse and average accuracies across all folds as specified in posproc=mean_sample()
-    sl = sphere_searchlight(cv, radius=RADIUS, nproc=N_PROC)  #, postproc=mean_sample())
-
-    # run searchlight
-    result = sl(dataset)
+    if SEARCHLIGHT_ENGINE == 'numpy':
+        # folds of HalfPartitioner(attr='modality'): 0 tests nav, 1 tests sac
+        # all radii in one pass, the spheres growing shell by shell
+        indexes = [neighbour_index(dataset.fa.voxel_indices, radius) for radius in RADII]
+        results = [Dataset(accuracy) for accuracy in
+                   cv_searchlight(dataset.samples, indexes, dataset.targets, dataset.sa.modality, n_proc=N_PROC)]
+    else:
+        # create partitions for training and testing
+        partitioner = HalfPartitioner(attr='modality')
+        # cross-validation
+        clf = LinearCSVMC()  # get_feature_selection_clf()  #
+        cv = CrossValidation(clf, partitioner, errorfx=lambda p, t: np.mean(p == t))
+        # initialize searchlight
+        # collapse and average accuracies across all folds as specified in posproc=mean_sample()
+        # run searchlight
+        results = [sphere_searchlight(cv, radius=radius, nproc=N_PROC)(dataset)  #, postproc=mean_sample())
+                   for radius in RADII]
 
     # write the searchlight map into the original space using the original header from dataset
-    for i in range(2):
-        # 0: eye predicts nav, 1: nav predicts eye
-        outfilename = OUTDIR + '%s_%s_xtask-move_twise_%svox_z_svm_%s.nii.gz' % (subj, DIRCT, RADIUS, i)
-        map2nifti(dataset, result.samples[i]).to_filename(outfilename)
+    for radius, result in zip(RADII, results):
+        for i in range(2):
+            # 0: eye predicts nav, 1: nav predicts eye
+            outfilename = OUTDIR + '%s_%s_xtask-move_twise_%svox_z_svm_%s.nii.gz' % (subj, DIRCT, radius, i)
+            map2nifti(dataset, result.samples[i]).to_filename(outfilename)
 
 
 if __name__ == '__main__':
-    with open('../lv1/good_trials.pkl', 'rb') as infile:
-        info = pkl.load(infile)
+    info = load_good_trials('../lv1/good_trials.npz')
     for subj in subject_list:
         main(subj, info)
@@ -6,12 +6,18 @@ import numpy as np
 import sys
 from itertools import product
 from subjects import *
+from searchlight import neighbour_index
+from rsa_kernel import sim_searchlight, perm_searchlight
+from sample_cache import cached_dataset
 
 TSTATS_DIR = '/u/project/cparkins/data/hierarchy/derivatives/lv1/tstats/'
 MASK_DIR = '/u/project/cparkins/data/hierarchy/derivatives/masks/ribbon_masks/'
 OUTDIR = '/u/project/cparkins/data/hierarchy/derivatives/mvpa_volume/xtask_sim_sl/native_sim_dil3mm0thr/'
 
-SEARCHLIGHT_RADIUS = 4
+SEARCHLIGHT_RADII = [4]  # increasing radii in voxels, one map per radius
+SEARCHLIGHT_ENGINE = 'pymvpa'  # 'numpy': cached sphere index (searchlight.py) and batched CustomDist (rsa_kernel.py)
+N_PROC = 6  # worker processes of the numpy engine, sharing memory-mapped samples
+N_PERMUTATIONS = 0  # > 0 (numpy engine): also write a p-map of label permutations within runs
 
 subject_list = sys.argv[1:] if len(sys.argv) > 1 else EVERYONE
 print(subject_list)
@@ -30,26 +36,26 @@ class CustomDist(Measure):
         self.labels = labels
 
     def _call(self, ds):
-        data_dsm = 1 - pdist(ds.samples, metric='correlation')
+        return Dataset([self.sim(ds.samples)])
+
+    def sim(self, samples):
+        data_dsm = 1 - pdist(samples, metric='correlation')
         data_dsm = np.arctanh(data_dsm)  # Fisher z transformation
         data_dsm = data_dsm[self.labels != 0]
         labels = self.labels[self.labels != 0]
         data_dsm = zscore(data_dsm)
         # difference between distances of same types of trials across run (labeled 1)
         # and different types of trals across run (labeled 2)
-        sim = np.mean(data_dsm[labels == 1]) - np.mean(data_dsm[labels == 2])
-        return Dataset([sim])
+        return np.mean(data_dsm[labels == 1]) - np.mean(data_dsm[labels == 2])
 
 
 def get_nav_sac_data(nav_attr, sac_attr, subj, subj_mask):
     # nav data
-    nav_ds = fmri_dataset(samples=TSTATS_DIR + 'nav_bin_tstats/%s_nav_bin.nii.gz' % subj,
-                          mask=subj_mask)
+    nav_ds = cached_dataset(TSTATS_DIR + 'nav_bin_tstats/%s_nav_bin.nii.gz' % subj, subj_mask)
     nav_ds.sa['chunks'] = nav_attr.chunks    # chunks: run #s
     nav_ds.sa['targets'] = nav_attr.targets  # targets: run types (up/down)
     # saccades data
-    sac_ds = fmri_dataset(samples=TSTATS_DIR + 'sac_tstats/%s_sac.nii.gz' % subj,
-                          mask=subj_mask)
+    sac_ds = cached_dataset(TSTATS_DIR + 'sac_tstats/%s_sac.nii.gz' % subj, subj_mask)
     sac_ds.sa['chunks'] = sac_attr.chunks
     sac_ds.sa['targets'] = sac_attr.targets
     sac_ds = sac_ds[np.isin(sac_ds.sa.targets, [POWERFUL_DIRCT, POWERLESS_DIRCT])]
@@ -86,12 +92,28 @@ def main():
 
         # searchlight
         similarity = CustomDist(labels)
-        searchlight = sphere_searchlight(similarity, SEARCHLIGHT_RADIUS)
-        searchlight_map = searchlight(dataset)
+        if SEARCHLIGHT_ENGINE == 'numpy':
+            # all radii in one pass, the spheres growing shell by shell
+            indexes = [neighbour_index(dataset.fa.voxel_indices, radius) for radius in SEARCHLIGHT_RADII]
+            if N_PERMUTATIONS:
+                # labels are permuted within runs; nav and sac runs share chunk numbers, so the sac ones are offset
+                sac = np.isin(dataset.targets, [POWERFUL_DIRCT, POWERLESS_DIRCT])
+                runs = np.asarray(dataset.sa.chunks) + sac * (np.max(dataset.sa.chunks) + 1)
+                maps = perm_searchlight(dataset.samples, indexes, similarity.labels, N_PERMUTATIONS,
+                                        runs, n_proc=N_PROC)
+            else:
+                maps = sim_searchlight(dataset.samples, indexes, similarity.labels, n_proc=N_PROC)
+        else:
+            maps = [sphere_searchlight(similarity, radius)(dataset) for radius in SEARCHLIGHT_RADII]
 
         # save files
-        nifti = map2nifti(data=searchlight_map, dataset=dataset)
-        nifti.to_filename(OUTDIR + '%s_%s_%dvox_sim.nii.gz' % (subj, DIRCT, SEARCHLIGHT_RADIUS))
+        for radius, searchlight_map in zip(SEARCHLIGHT_RADII, maps):
+            if SEARCHLIGHT_ENGINE == 'numpy' and N_PERMUTATIONS:
+                p_file = OUTDIR + '%s_%s_%dvox_sim_p.nii.gz' % (subj, DIRCT, radius)
+                map2nifti(data=searchlight_map[1:], dataset=dataset).to_filename(p_file)
+                searchlight_map = searchlight_map[:1]
+            nifti = map2nifti(data=searchlight_map, dataset=dataset)
+            nifti.to_filename(OUTDIR + '%s_%s_%dvox_sim.nii.gz' % (subj, DIRCT, radius))
 
 
 if __name__ == '__main__':